@@ -0,0 +1,49 @@
+import time
+
+import numpy as np
+
+from mapmaker.noise import Perlin2d
+from mapmaker.smoothing import choose_mode, gaussian_smooth
+
+
+def timeit(func, *args, repeat=1, **kwargs):
+    """返回多次运行中的最短用时（秒）"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best  = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_perlin(sizes=((200, 160), (500, 400), (1000, 800)), cells=(10,10), seed=1586):
+    """比较柏林噪声逐点计算和整体计算的用时"""
+    print('Perlin2d: size, point (s), array (s), speedup')
+    for width, height in sizes:
+        x   = np.linspace(0, 100, width,  endpoint=False)
+        y   = np.linspace(0, 80,  height, endpoint=False)
+        X,Y = np.meshgrid(x,y)
+        t_point = timeit(Perlin2d(cells, seed=seed, mode='point'), X, Y)
+        t_array = timeit(Perlin2d(cells, seed=seed, mode='array'), X, Y, repeat=3)
+        print(f'  {width} x {height}: {t_point:.3f}, {t_array:.3f}, {t_point/t_array:.1f}x')
+
+
+def bench_smoothing(sizes=(200, 400, 800, 1600), radii=(2, 4, 8, 16, 24, 32, 48, 64, 128), budget=5e8):
+    """比较各平滑方式在不同核半径和网格大小下的用时，用于确定自动选择的分界点"""
+    modes = ('direct', 'separable', 'fft', 'box')
+    print('Gaussian smoothing: size, radius, ' + ', '.join(f'{m} (s)' for m in modes) + ', auto')
+    for size in sizes:
+        frame = (np.random.default_rng(size).random((size, size)) > 0.5).astype(float)
+        for radius in radii:
+            row = []
+            for mode in modes:
+                if mode == 'direct' and size**2 * (2*radius+1)**2 > budget:
+                    row.append('-')
+                else:
+                    row.append(f'{timeit(gaussian_smooth, frame, radius/2, radius, mode=mode):.4f}')
+            print(f'  {size} x {size}, {radius}: ' + ', '.join(row) + f', {choose_mode(frame.shape, radius)}')
+
+
+if __name__ == '__main__':
+    bench_perlin()
+    bench_smoothing()
@@ -4,7 +4,9 @@
 
 from .map import Map
 from .altitude import AltitudeMap, Continent
-from .unit import City, River
+from .unit import Cities, City, River
+from .batch import generate_batch
+from .tiles import TileSource
 
 
 __all__ = [
@@ -12,5 +14,8 @@ __all__ = [
     'AltitudeMap', 
     'Continent', 
     'City', 
+    'Cities', 
     'River', 
+    'generate_batch', 
+    'TileSource', 
 ]
@@ -1,10 +1,15 @@
-import matplotlib.pyplot as plt
+import os
+import tempfile
 import numpy as np
-from numpy import random
-from scipy.signal import convolve2d
+
+try: 
+    import matplotlib.pyplot as plt
+except ImportError:   #无 matplotlib 时仍可生成高度图，但无法绘图
+    plt = None
 
 from .noise import Perlin2d
 from .randombase import RandomBase
+from .smoothing import gaussian_smooth, smoothing_halo
 
 
 class AltitudeMap(RandomBase): 
@@ -14,8 +19,9 @@ class AltitudeMap(RandomBase):
         continent_number=1, slope=5, width_range=(0.25,0.75), height_range=(0.25,0.75),
         perlin_cells=(10,10), 
         longtitude_range=100, latitude_range=80, resolution=1, 
-        generate=True, generate_sea=True): 
-        super().__init__(seed)
+        generate=True, generate_sea=True, smoothing='auto', 
+        tile_size=None, tile_path=None, legacy=None): 
+        super().__init__(seed, legacy=legacy)
         if not name: 
             self.name       = 'Unnamed altitude map'
         else: 
@@ -29,8 +35,12 @@ class AltitudeMap(RandomBase):
         self.resolution     = resolution
         self.range          = np.array([longtitude_range, latitude_range])
         self.size           = resolution*self.range
+        self.smoothing      = smoothing
         self.continent_dict = {}
-        if generate: 
+        if generate and tile_size: 
+            self.generate_tiled(land_level, slope, noise_level, 
+                sea_level if generate_sea else None, tile_size, tile_path)
+        elif generate: 
             self.generate(land_level, slope, noise_level)
             if generate_sea: self.add_sea(sea_level)
             self.map = self.nornalize(self.map)
@@ -53,29 +63,89 @@ class AltitudeMap(RandomBase):
         self.generate_perlin_noise(X,Y)
         self.map = self.continents + 2*noise_level*self.noise
 
+    def generate_tiled(self, land_level, slope, noise_level, sea_level=None, 
+        tile_size=512, path=None): 
+        """
+        分块生成高度图，逐块写入磁盘上的内存映射数组，内存占用只与块大小有关
+        
+        每块向外扩展平滑核半径的宽度后再做大陆平滑，噪声按整体范围计算，
+        因此结果与整体生成一致。高度图存为 path 下的 altitude.npy，
+        sea_level 不为 None 时加入海洋，海洋处理前的高度图存为 nonsea.npy。
+        不保留 frame, continents 和 noise。
+        """
+        if not path: path = tempfile.mkdtemp(prefix='mapmaker_')
+        if not os.path.exists(path): os.makedirs(path)
+        cols, rows = self.size
+        x      = np.linspace(0, self.width,  cols, endpoint=False)
+        y      = np.linspace(0, self.height, rows, endpoint=False)
+        bounds = (x[0], x[-1], y[0], y[-1])
+        sigma  = slope*self.resolution
+        halo   = smoothing_halo(sigma, mode=self.smoothing)
+        self.create_continents()
+        p = Perlin2d(cells=self.perlin_cells, seed=self.seed, rng=self.spawn_rng('perlin'), legacy=self.legacy)
+        p.generate_gradient()
+        self.map_file = os.path.join(path, 'altitude.npy')
+        self.map = np.lib.format.open_memmap(self.map_file, mode='w+', dtype=float, shape=(rows, cols))
+        if sea_level is not None: 
+            self.nonsea_file = os.path.join(path, 'nonsea.npy')
+            self.nonsea_map  = np.lib.format.open_memmap(
+                self.nonsea_file, mode='w+', dtype=float, shape=(rows, cols))
+        lowest  = np.inf
+        highest = -np.inf
+        for i0 in range(0, rows, tile_size): 
+            i1 = min(i0 + tile_size, rows)
+            a0 = max(i0 - halo, 0)
+            a1 = min(i1 + halo, rows)
+            for j0 in range(0, cols, tile_size): 
+                j1 = min(j0 + tile_size, cols)
+                b0 = max(j0 - halo, 0)
+                b1 = min(j1 + halo, cols)
+                frame = np.zeros((a1-a0, b1-b0), dtype=bool)
+                for continent in self.continent_dict.values(): 
+                    continent.rasterize(x[b0:b1], y[a0:a1], frame)
+                smooth = gaussian_smooth(frame, sigma=sigma, mode=self.smoothing)
+                X,Y    = np.meshgrid(x[j0:j1], y[i0:i1])
+                tile   = land_level*smooth[i0-a0:i1-a0, j0-b0:j1-b0] + 2*noise_level*p.evaluate(X, Y, bounds)
+                if sea_level is not None: 
+                    self.nonsea_map[i0:i1, j0:j1] = tile
+                    tile = self.clip_sea(tile, sea_level)
+                self.map[i0:i1, j0:j1] = tile
+                lowest  = min(lowest,  tile.min())
+                highest = max(highest, tile.max())
+        for i0 in range(0, rows, tile_size): 
+            self.map[i0:i0+tile_size] = (self.map[i0:i0+tile_size] - lowest) / (highest - lowest)
+        self.map.flush()
+        if sea_level is not None: self.nonsea_map.flush()
+
     def generate_world_frame(self, X, Y): 
         """生成世界大陆框架"""
         self.frame = np.zeros_like(X, dtype=bool)
+        self.create_continents()
+        x = X[0]
+        y = Y[:,0]
+        for continent in self.continent_dict.values(): 
+            continent.rasterize(x, y, self.frame)
+    
+    def create_continents(self): 
+        """按大陆数量随机创建大陆"""
         self.continent_contour = {}
         if self.create_number > 0: 
             if self.create_number == 1: 
                 self.create_center_continent()
             elif self.create_number > 1: 
                 self.create_random_continents(number=self.create_number)
-        for continent in self.continent_dict.values(): 
-            self.frame += continent(X, Y)
     
     def create_center_continent(self, edges=5, base=0.9): 
         """随即创建唯一的中央大陆"""
         center    = self.range/2
-        randvec   = random.rand(edges) * base**np.arange(edges, 0, -1)
+        randvec   = self.rng.random(edges) * base**np.arange(edges, 0, -1)
         continent = Continent(*center, center.min(), 
             0.2*center.min(), *randvec, name='Random continent')
         self.continent_dict['Random continent'] = continent
     
     def create_random_continents(self, number=5, edges=5, base=0.9, wave_scale=0.2): 
         """随机创建多块大陆"""
-        randmat = random.rand(number, 2, edges + 4)
+        randmat = self.rng.random((number, 2, edges + 4))
         x0      = self.width_range[0]
         x1      = self.width_range[1]
         y0      = self.height_range[0]
@@ -93,12 +163,11 @@ class AltitudeMap(RandomBase):
     def generate_continents(self, average, slope): 
         """生成大陆"""
         frame = self.frame.astype(float)
-        gauss = self.__gaussian_kernel(sigma=slope*self.resolution)
-        self.continents = average*convolve2d(frame, gauss, mode='same')
+        self.continents = average*gaussian_smooth(frame, sigma=slope*self.resolution, mode=self.smoothing)
     
     def generate_perlin_noise(self, X, Y): 
         """生成柏林噪声"""
-        p = Perlin2d(cells=self.perlin_cells, seed=self.seed)
+        p = Perlin2d(cells=self.perlin_cells, seed=self.seed, rng=self.spawn_rng('perlin'), legacy=self.legacy)
         self.noise = p(X,Y)
     
     def add_sea(self, sea_level=0.5): 
@@ -108,17 +177,12 @@ class AltitudeMap(RandomBase):
     
     def only_land(self, sea_level=0.5): 
         """只保留陆地高度"""
-        return np.vectorize(lambda x: 1*(x > sea_level)*(x - sea_level))(self.map)
-    
-    def __gaussian_kernel(self, sigma, radius=0): 
-        if radius == 0: radius = int(2*sigma)
-        x      = np.arange(-radius, radius+1)
-        y      = np.arange(-radius, radius+1)
-        X,Y    = np.meshgrid(x,y)
-        func   = np.vectorize(lambda x, y: np.exp(-(x**2 + y**2) / (2*sigma**2)))
-        kernel = func(X,Y)
-        return kernel / kernel.sum()
-
+        return self.clip_sea(self.map, sea_level)
+    
+    def clip_sea(self, map, sea_level=0.5): 
+        """将海平面以下的高度置零，海平面以上的高度减去海平面"""
+        return np.where(map > sea_level, map - sea_level, 0.0)
+    
     def nornalize(self, map): 
         """归一化地图"""
         highest = map.max()
@@ -188,11 +252,13 @@ class Continent:
     
     def contour(self, theta): 
         """大陆框架轮廓的极坐标函数"""
-        func = np.vectorize(
-            lambda theta: 0.5*self.diameter + self.wave_height*\
-            (self.fourier * np.sin(theta*np.arange(1, self.fourier.size+1))).sum()
-        )
-        return func(theta)
+        theta = np.asarray(theta, dtype=float)
+        k     = np.arange(1, self.fourier.size+1)
+        return 0.5*self.diameter + self.wave_height*(np.sin(np.multiply.outer(theta, k)) @ self.fourier)
+    
+    def bounding_radius(self): 
+        """大陆框架外接圆半径"""
+        return 0.5*self.diameter + abs(self.wave_height)*np.abs(self.fourier).sum()
     
     def contour_plot(self): 
         """绘制大陆框架的轮廓"""
@@ -204,24 +270,21 @@ class Continent:
     
     def local_func(self, X, Y): 
         """大陆视角的大陆框架函数"""
-        @np.vectorize
-        def local_func(x,y): 
-            r, theta = self.__convert_polar(x,y)
-            r0       = self.contour(theta)
-            return (r < r0)
-        return local_func(X,Y)
-    
-    def __convert_polar(self, x, y): 
-        r = np.sqrt(x**2 + y**2)
-        theta = 0
-        if r != 0: theta = np.arccos(x/r)
-        if y  < 0: theta = -theta
-        if y == 0 and x < 0: theta = np.pi
-        return r, theta
+        r     = np.hypot(X, Y)
+        theta = np.arctan2(Y, X)
+        return r < self.contour(theta)
     
     def global_func(self, X, Y): 
         """全球视角的大陆框架函数"""
         return self.local_func(X - self.xc, Y - self.yc)
-
-
-
+    
+    def rasterize(self, x, y, frame=None): 
+        """在递增坐标轴 x, y 构成的网格上绘制大陆框架，只计算外接圆内的部分"""
+        if frame is None: frame = np.zeros((y.size, x.size), dtype=bool)
+        radius = self.bounding_radius()
+        i0, i1 = np.searchsorted(y, [self.yc - radius, self.yc + radius], side='right')
+        j0, j1 = np.searchsorted(x, [self.xc - radius, self.xc + radius], side='right')
+        if i0 < i1 and j0 < j1: 
+            X,Y = np.meshgrid(x[j0:j1], y[i0:i1])
+            frame[i0:i1, j0:j1] |= self.global_func(X, Y)
+        return frame
@@ -0,0 +1,92 @@
+"""
+多进程批量生成地图
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import storage
+from .altitude import AltitudeMap
+from .map import Map
+
+
+def make_task(item, data_path='data', polish=3, export=False, rivers=False):
+    """
+    将种子或参数字典整理为生成任务
+
+    参数字典可包含：
+        seed      高度图随机种子（必需）
+        map_seed  地图随机种子，默认与 seed 相同
+        name      地图名，默认为 'seed <seed>'
+        polish    优化次数
+        export    是否导出 PNG 图片，见 Map.export
+        rivers    是否按高度图自动生成河流，可为传给 Map.generate_rivers 的参数字典
+        altitude  传给 AltitudeMap 的其他参数
+    """
+    if not isinstance(item, dict): item = {'seed': item}
+    task = {
+        'seed'     : int(item['seed']),
+        'map_seed' : int(item.get('map_seed', item['seed'])),
+        'name'     : item.get('name', f"seed {item['seed']}"),
+        'polish'   : item.get('polish', polish),
+        'export'   : item.get('export', export),
+        'rivers'   : item.get('rivers', rivers),
+        'altitude' : dict(item.get('altitude', {})),
+        'data_path': item.get('data_path', data_path),
+    }
+    return task
+
+
+def generate_world(task):
+    """生成一张地图并写入数据文件夹，返回生成结果概要"""
+    start = time.perf_counter()
+    p = AltitudeMap(seed=task['seed'], **task['altitude'])
+    m = Map(p, data_path=task['data_path'], name=task['name'], seed=task['map_seed'],
+        cities=False, rivers=False, save=False)
+    m.polish(task['polish'], history=False)
+    storage.save_array(m.altitude_file, m.altitude_map)
+    if task['rivers']: 
+        m.generate_rivers(**{'cover': True, **(task['rivers'] if isinstance(task['rivers'], dict) else {})})
+    return {
+        'name'   : m.name,
+        'seed'   : task['seed'],
+        'path'   : m.path,
+        'rivers' : len(m.rivers),
+        'image'  : m.export() if task['export'] else None,
+        'rows'   : m.rows,
+        'cols'   : m.cols,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def generate_batch(items, data_path='data', polish=3, workers=None, progress=True, export=False, 
+    rivers=False):
+    """
+    按种子或参数字典列表批量生成地图，分发到进程池中执行
+
+    每个任务在开始时按自己的种子重置随机状态，结果与进程数无关。
+    返回与 items 顺序相同的生成结果概要列表。
+    """
+    tasks   = [make_task(item, data_path, polish, export, rivers) for item in items]
+    results = [None]*len(tasks)
+    if not workers: workers = os.cpu_count()
+    start = time.perf_counter()
+    if workers == 1:
+        for i, task in enumerate(tasks):
+            results[i] = generate_world(task)
+            if progress: report(i+1, len(tasks), results[i], start)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(generate_world, task): i for i, task in enumerate(tasks)}
+            for done, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                if progress: report(done+1, len(tasks), results[futures[future]], start)
+    return results
+
+
+def report(done, total, result, start):
+    """打印进度和吞吐量"""
+    elapsed = time.perf_counter() - start
+    print(f"[{done}/{total}] {result['name']}: {result['rows']} x {result['cols']}, "
+        f"{result['seconds']:.2f} s, {60*done/elapsed:.1f} maps/min")
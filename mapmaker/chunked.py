@@ -0,0 +1,115 @@
+"""
+按行分块、多线程执行的地图逐格运算
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import kernels
+
+
+class ChunkedExecutor:
+    """
+    将地图按固定行数 band 分块，在线程池中逐块执行，需要相邻格点的运算向外多读一行
+
+    随机数由 random(i0, i1) 按行给出，只与格点坐标有关，因此结果与 band 和线程数 workers 无关。
+    块内的随机数和查表用的整数下标每次只生成 block 行，block 不影响结果，只影响临时数组的大小。
+    """
+    def __init__(self, workers=1, band=256, block=32):
+        self.workers = workers
+        self.band    = band
+        self.block   = block
+
+    def bands(self, rows):
+        """各块的 (编号, 起始行, 结束行)"""
+        return [(k, i0, min(i0 + self.band, rows)) for k, i0 in enumerate(range(0, rows, self.band))]
+
+    def run(self, task, rows):
+        """对每一块执行 task(k, i0, i1)"""
+        bands = self.bands(rows)
+        if self.workers == 1 or len(bands) == 1:
+            for band in bands: task(*band)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for future in [pool.submit(task, *band) for band in bands]: future.result()
+
+    def upsample(self, map, cut, out=None):
+        """分块最近邻放大"""
+        rows, cols = map.shape
+        if out is None: out = np.empty((cut*rows, cut*cols), dtype=map.dtype)
+        def task(k, i0, i1):
+            kernels.upsample(map[i0:i1], cut, out[cut*i0:cut*i1])
+        self.run(task, rows)
+        return out
+
+    def classify(self, map, table):
+        """分块查表分类"""
+        out = np.empty(map.shape, dtype=table.dtype)
+        def task(k, i0, i1):
+            self.__take(table, map, i0, i1, out)
+        self.run(task, map.shape[0])
+        return out
+
+    def weathering(self, map, intensity, random, engine='auto'):
+        """分块风化，random(i0, i1) 返回第 i0 到 i1 行的随机数，形状为 (i1-i0, cols, 2)"""
+        rows = map.shape[0]
+        out = np.empty_like(map)
+        def task(k, i0, i1):
+            self.__weathering_band(map, random, 0, intensity, engine, i0, i1, out)
+        self.run(task, rows)
+        return out
+
+    def refine_weathering(self, map, cut, intensity, random, engine='auto', out=None):
+        """
+        放大与风化合并为一次分块计算，不生成完整的放大地图，结果与先 upsample 再 weathering 相同
+
+        每块只放大所需的源地图行（含上下各一行）。
+        """
+        rows, cols = cut*map.shape[0], cut*map.shape[1]
+        if out is None: out = np.empty((rows, cols), dtype=map.dtype)
+        if engine == 'auto': engine = kernels.choose_engine(rows*cols)
+        def task(k, i0, i1):
+            a0      = max(i0 - 1, 0)
+            a1      = min(i1 + 1, rows)
+            s0      = a0//cut
+            refined = kernels.upsample(map[s0:(a1-1)//cut + 1], cut)[a0 - cut*s0:a1 - cut*s0]
+            self.__weathering_band(refined, random, a0, intensity, engine, i0 - a0, i1 - a0, out[a0:a1])
+        self.run(task, rows)
+        return out
+
+    def __take(self, table, map, i0, i1, out):
+        for j0 in range(i0, i1, self.block):
+            j1 = min(j0 + self.block, i1)
+            np.take(table, map[j0:j1], out=out[j0:j1])
+
+    def __weathering_band(self, map, random, offset, intensity, engine, i0, i1, out):
+        # map 的第 0 行为整张地图的第 offset 行
+        for j0 in range(i0, i1, self.block):
+            j1 = min(j0 + self.block, i1)
+            kernels.weathering(map, random(offset + j0, offset + j1), intensity, engine, j0, j1, out)
+
+    def coastline(self, map, table, value, connectivity=4, thickness=1, edge='skip'):
+        """
+        分块计算海岸线并直接将 map 中的海岸线格点设为 value，不生成完整的陆地和海岸线掩码
+
+        每块向外多读 thickness 行，陆地按查找表 table 逐块计算，参数含义见 kernels.coastline_mask。
+        海岸线格点原本就是陆地，value 也须为陆地，因此相邻块已写入的格点不改变本块的陆地判断。
+        """
+        def task(k, i0, i1):
+            map[i0:i1][self.__coastline_band(map, table, i0, i1, connectivity, thickness, edge)] = value
+        self.run(task, map.shape[0])
+        return map
+
+    def __coastline_band(self, map, table, i0, i1, connectivity, thickness, edge):
+        rows = map.shape[0]
+        a0   = max(i0 - thickness, 0)
+        a1   = min(i1 + thickness, rows)
+        land = np.take(table, map[a0:a1])
+        mask = kernels.coastline_mask(land, connectivity, thickness,
+            'land' if edge == 'skip' else edge)[i0-a0:i1-a0]
+        if edge == 'skip':
+            mask[:, [0, -1]] = False
+            if i0 == 0:    mask[0]  = False
+            if i1 == rows: mask[-1] = False
+        return mask
@@ -1,22 +1,36 @@
+import os
 import numpy as np
-import pandas as pd
-from numpy import random
 
+from . import kernels, storage
 from .altitude import AltitudeMap
+from .chunked import ChunkedExecutor
 from .data.color_dict import color_dict
 from .noise import Perlin2d
 from .randombase import RandomBase
+from .render import make_palette
 
 
 class MapBase(RandomBase): 
     """基础地图对象，包含地图读取和地图随机生成"""
-    def __init__(self, origin_map=None, seed=None): 
-        super().__init__(seed)
+    def __init__(self, origin_map=None, seed=None, lazy=False, legacy=None): 
+        super().__init__(seed, legacy=legacy)
+        self.lazy     = lazy
+        self.executor = ChunkedExecutor()
         self.set_land_index()
         self.set_origin_map(origin_map)
-        self.map = self.origin_map.copy()
+        self.map  = self.origin_map if lazy else self.origin_map.copy()
+        self.land = None
         self.set_range()
-        self.only_land()
+    
+    @property
+    def land(self): 
+        """陆地掩码，地图改变后首次访问时重新计算"""
+        if self.__land is None: self.only_land()
+        return self.__land
+    
+    @land.setter
+    def land(self, land): 
+        self.__land = land
 
     def set_land_index(self): 
         self.color_dict      = color_dict
@@ -25,27 +39,42 @@ class MapBase(RandomBase):
         for index, landtype in enumerate(self.color_dict.keys()): 
             self.index_land_dict[index]    = landtype
             self.land_index_dict[landtype] = index
+        self.land_dtype = np.min_scalar_type(len(self.color_dict) - 1)
+        self.palette    = make_palette(self.color_dict)
+        self.land_table = self.lookup_table(('海洋', '水域'), inside=False, outside=True)
+    
+    def lookup_table(self, landtypes, inside, outside, dtype=bool): 
+        """按地块编号索引的查找表，landtypes 中的地块取 inside，其余取 outside"""
+        table = np.full(len(self.color_dict), outside, dtype=dtype)
+        table[[self.land_index_dict[landtype] for landtype in landtypes]] = inside
+        return table
+    
+    def classify(self, map, table): 
+        """用查找表对地图逐格分类"""
+        return self.executor.classify(map, table)
 
     def set_origin_map(self, origin_map): 
         if origin_map is None: 
-            origin_map = AltitudeMap(seed=self.seed)
+            origin_map = AltitudeMap(seed=self.seed, legacy=self.legacy)
         if type(origin_map)   == AltitudeMap: 
             self.altitude_source     = origin_map
             self.altitude_map        = origin_map.map
             self.convert_altitude2normal()
-        elif type(origin_map) == np.ndarray: 
+        elif isinstance(origin_map, np.ndarray): 
             self.__set_by_matrix(origin_map)
         elif type(origin_map) == str:
-            origin_map = pd.read_csv(origin_map, sep=',', header=None).values
+            # 地图文件夹中只有旧版文本矩阵时，先转换为 .npy 文件
+            if not os.path.exists(origin_map): storage.migrate(os.path.dirname(origin_map) or '.')
+            origin_map = storage.load_array(origin_map, mmap_mode='c' if self.lazy else None)
             self.__set_by_matrix(origin_map)
 
     def __set_by_matrix(self, origin_map):
-        if origin_map.dtype == 'float64': 
+        if np.issubdtype(origin_map.dtype, np.floating): 
             self.altitude_source = None
             self.altitude_map    = origin_map
             self.convert_altitude2normal()
-        elif origin_map.dtype == 'int64': 
-            self.origin_map      = origin_map
+        elif np.issubdtype(origin_map.dtype, np.integer): 
+            self.origin_map      = origin_map.astype(self.land_dtype, copy=not self.lazy)
             self.altitude_source = None
             self.altitude_map    = np.array([])
     
@@ -58,19 +87,12 @@ class MapBase(RandomBase):
         prairie  = self.land_index_dict['草原']
         mountain = self.land_index_dict['山地']
         peak     = self.land_index_dict['高峰']
-        @np.vectorize
-        def color_by_altitude(x): 
-            if   x == 0: 
-                return ocean
-            elif x < shollow_level: 
-                return water
-            elif x > peak_level: 
-                return peak
-            elif x > mountain_level: 
-                return mountain
-            else: 
-                return prairie
-        self.origin_map = color_by_altitude(self.altitude_map).astype(np.int64)
+        x = self.altitude_map
+        self.origin_map = np.select(
+            [x == 0, x < shollow_level, x > peak_level, x > mountain_level], 
+            [ocean,  water,             peak,           mountain], 
+            default=prairie
+        ).astype(self.land_dtype)
 
     def set_range(self, left=None, right=None, top=None, bottom=None): 
         self.height, self.width = self.map.shape
@@ -81,30 +103,19 @@ class MapBase(RandomBase):
         self.range = [left, right, bottom, top]
     
     def only_land(self): 
-        ocean = self.land_index_dict['海洋']
-        water = self.land_index_dict['水域']
-        @np.vectorize
-        def is_land(x): 
-            return not (x == ocean or x == water)
-        self.land = is_land(self.map)
+        self.land = self.classify(self.map, self.land_table)
     
     def extract_layer(self, *layer_names): 
-        lst = [self.land_index_dict['其他']]
+        table = np.full(len(self.color_dict), self.land_index_dict['其他'], dtype=self.land_dtype)
         for name in layer_names: 
-            lst.append(self.land_index_dict[name])
-        @np.vectorize
-        def is_layer(x): 
-            if x in lst: 
-                return x
-            else: 
-                return lst[0]
-        self.extract_map = is_layer(self.map)
+            table[self.land_index_dict[name]] = self.land_index_dict[name]
+        self.extract_map = self.classify(self.map, table)
 
 
 class ChangeableMap(MapBase): 
     """地块可变地图对象"""
-    def __init__(self, origin_map=None, seed=None, cut_times=0): 
-        super().__init__(origin_map, seed)
+    def __init__(self, origin_map=None, seed=None, cut_times=0, lazy=False, legacy=None): 
+        super().__init__(origin_map, seed, lazy, legacy)
         self.rows      = self.height
         self.cols      = self.width
         self.cut_times = cut_times
@@ -112,87 +123,140 @@ class ChangeableMap(MapBase):
     
     def assign_plant(self, proportion=[0.2, 0.2, 0.2, 0.2, 0.2], 
         areas=['森林', '沃土', '草原', '戈壁', '荒漠'], cells=None): 
-        new_map = self.map.copy().astype(np.int64)
+        self.map = self.planted(self.map, 0, 0, proportion, areas, cells)
+        self.changed = True
+    
+    def planted(self, map, top=0, left=0, proportion=[0.2, 0.2, 0.2, 0.2, 0.2], 
+        areas=['森林', '沃土', '草原', '戈壁', '荒漠'], cells=None): 
+        """
+        按柏林噪声将 areas 中的地块重新指派为森林、沃土、草原、戈壁、荒漠，返回新的地图
+
+        map 为当前地图中从第 top 行、第 left 列开始的区域，噪声按整张地图的坐标计算。
+        """
         if cells is None: cells = 5
         if type(cells) == int: 
             cells = (cells, np.ceil(cells*self.rows/self.cols).astype(int))
-        p   = Perlin2d(cells, seed = self.seed)
-        x   = np.arange(self.cols)
-        y   = np.arange(self.rows)
+        p   = Perlin2d(cells, seed = self.seed, rng=self.spawn_rng('plant'), legacy=self.legacy)
+        p.generate_gradient()
+        x   = np.arange(left, left + map.shape[1])
+        y   = np.arange(top, top + map.shape[0])
         X,Y = np.meshgrid(x,y)
+        noise    = p.evaluate(X, Y, (0, self.cols - 1, 0, self.rows - 1)) + 0.5
         aimland  = [self.land_index_dict[area] for area in areas]
-        forest   = self.land_index_dict['森林']
-        farmland = self.land_index_dict['沃土']
-        prairie  = self.land_index_dict['草原']
-        gobi     = self.land_index_dict['戈壁']
-        desert   = self.land_index_dict['荒漠']
-        sum = 0
-        accumulate = []
-        for pi in proportion:
-            sum += pi
-            accumulate.append(sum)
-        accumulate = [accumulate[i]/sum for i in range(len(accumulate))]
-        @np.vectorize
-        def assign(x, noise): 
-            if x in aimland: 
-                if noise < accumulate[0]: 
-                    return forest
-                elif noise < accumulate[1]: 
-                    return farmland
-                elif noise < accumulate[2]: 
-                    return prairie
-                elif noise < accumulate[3]: 
-                    return gobi
-                else: 
-                    return desert
-            else: 
-                return x
-        new_map  = assign(new_map, p(X,Y) + 0.5)
-        self.map = new_map.astype(np.int64)
-        self.changed = True
+        plants   = np.array([self.land_index_dict[area] for area in ['森林', '沃土', '草原', '戈壁', '荒漠']])
+        accumulate = np.cumsum(proportion)
+        accumulate = accumulate / accumulate[-1]
+        plant    = plants[np.searchsorted(accumulate[:len(plants)-1], noise, side='right')]
+        return np.where(np.isin(map, aimland), plant, map).astype(self.land_dtype)
     
-    def refine(self, cut=2): 
-        """增加地图分辨率"""
-        new_mat = np.empty((cut*self.rows, cut*self.cols))
-        for i, column in enumerate(self.map): 
-            new_column = np.repeat(column, cut)
-            for j in range(cut): 
-                new_mat[cut*i+j] = new_column
-        self.map = new_mat.astype(np.int64)
+    def refine(self, cut=2, out=None): 
+        """增加地图分辨率，可给定预先分配的输出数组 out"""
+        self.map = self.executor.upsample(self.map, cut, out)
         self.rows, self.cols = self.map.shape
         self.cut_times += 1
         self.changed = True
-        self.only_land()
-
-    def weathering(self, intensity=0.1): 
-        """随机改变地形"""
-        new_map = self.map.copy()
-        random.seed(self.seed)
-        randmat = random.rand(self.rows, self.cols, 2)
-        for i in range(1, self.rows-1): 
-            for j in range(1, self.cols-1): 
-                if randmat[i,j,0] > 1 - intensity: 
-                    new_map[i,j] = self.map[i+1, j]
-                elif randmat[i,j,0] < intensity: 
-                    new_map[i,j] = self.map[i-1, j]
-                if randmat[i,j,1] > 1 - intensity: 
-                    new_map[i,j] = self.map[i, j+1]
-                elif randmat[i,j,1] < intensity: 
-                    new_map[i,j] = self.map[i, j-1]
-        self.map = new_map.astype(np.int64)
-        self.only_land()
+        self.land    = None
+    
+    def refined_view(self, cut=2): 
+        """不复制数据的放大视图，形状为 (rows, cut, cols, cut)"""
+        return kernels.upsample_view(self.map, cut)
+
+    def weathering(self, intensity=0.1, engine='auto'): 
+        """随机改变地形，engine 可选 'numpy' 或 'numba'；非 legacy 模式下使用按坐标哈希的随机数并多线程分块计算"""
+        if self.legacy: 
+            randmat  = self.spawn_rng('weathering').random((self.rows, self.cols, 2))
+            new_map  = kernels.weathering(self.map, randmat, intensity, engine)
+        else: 
+            random   = self.weathering_random(self.cut_times, 0, self.cols)
+            new_map  = self.executor.weathering(self.map, intensity, random, engine)
+        self.map = new_map.astype(self.land_dtype, copy=False)
+        self.land    = None
         self.changed = True
 
-    def coastline(self): 
-        """生成海岸线"""
-        new_map       = self.map.copy()
-        boundary_line = self.land_index_dict['边界']
-        for i in range(1, self.rows-1): 
-            for j in range(1, self.cols-1): 
-                if self.land[i,j]: 
-                    if not (self.land[i+1, j] and self.land[i-1, j] \
-                        and self.land[i, j+1] and self.land[i, j-1]): 
-                        new_map[i,j] = boundary_line
-        self.map = new_map.astype(np.int64)
+    def fused_polish(self, times=1, cut=2, intensity=0.1, engine='auto', record=None): 
+        """
+        放大和风化合并计算 times 轮，结果与逐轮 refine 和 weathering 相同
+
+        各轮交替读写两块预先分配的缓冲区（最终尺寸和倒数第二轮的尺寸），不生成陆地掩码，
+        峰值内存约为 1.25 张最终尺寸的地图（逐轮计算时约为 2.25 张）。record(i, map) 在第 i 轮结束时调用，
+        map 所在缓冲区会被之后的轮次覆盖，需要保留时应复制。legacy 模式下逐轮计算。
+        """
+        if self.legacy: 
+            for i in range(times): 
+                self.refine(cut)
+                self.weathering(intensity, engine)
+                if record: record(i+1, self.map)
+            return
+        if times < 1: return
+        size    = self.rows*self.cols*cut**(2*times)
+        buffers = [np.empty(size//cut**(2*k), dtype=self.land_dtype) for k in range(2)]
+        for i in range(times): 
+            rows, cols = cut*self.rows, cut*self.cols
+            out  = buffers[(times - 1 - i) % 2][:rows*cols].reshape(rows, cols)
+            self.cut_times += 1
+            random = self.weathering_random(self.cut_times, 0, cols)
+            self.executor.refine_weathering(self.map, cut, intensity, random, engine, out)
+            self.map = out
+            self.rows, self.cols = rows, cols
+            if record: record(i+1, self.map)
+        self.land    = None
+        self.changed = True
+    
+    def weathering_random(self, level, left, right): 
+        """第 level 次放大后风化所用的随机数，返回 random(i0, i1)，给出第 i0 到 i1 行、第 left 到 right 列的随机数"""
+        return lambda i0, i1: self.hash_random('weathering', level, range(i0, i1), range(left, right))
+
+    def viewport(self, rows, cols, times=1, cut=2, intensity=0.1, assign_plant=True, 
+        coastline=True, engine='auto'): 
+        """
+        只生成放大 times 次后地图的一个矩形区域，结果与整张地图 polish 后截取该区域相同
+
+        rows=(top, bottom) 和 cols=(left, right) 为放大后地图中的行列范围，不修改当前地图。
+        每次放大只计算所需区域及向外一格的邻域，随机数按格点坐标生成，因此各区域可以分别按需生成。
+        legacy 模式使用全局随机状态，不能按区域生成。
+        """
+        if self.legacy: 
+            raise ValueError("viewport requires legacy=False.")
+        shape  = [(self.rows*cut**k, self.cols*cut**k) for k in range(times + 1)]
+        halo   = 1 if coastline else 0
+        top, bottom = max(rows[0], 0), min(rows[1], shape[-1][0])
+        left, right = max(cols[0], 0), min(cols[1], shape[-1][1])
+        # 自顶向下求出每一层需要计算的区域 (行起点, 行终点, 列起点, 列终点)
+        bounds = [(max(top - halo, 0), min(bottom + halo, shape[-1][0]), 
+                   max(left - halo, 0), min(right + halo, shape[-1][1]))]
+        for k in range(times, 0, -1): 
+            i0, i1, j0, j1 = bounds[0]
+            bounds.insert(0, (max(i0 - 1, 0)//cut, (min(i1 + 1, shape[k][0]) - 1)//cut + 1, 
+                              max(j0 - 1, 0)//cut, (min(j1 + 1, shape[k][1]) - 1)//cut + 1))
+        i0, i1, j0, j1 = bounds[0]
+        map = self.map[i0:i1, j0:j1]
+        if assign_plant: map = self.planted(map, i0, j0)
+        for k in range(1, times + 1): 
+            s0, _, t0, _   = bounds[k-1]
+            i0, i1, j0, j1 = bounds[k]
+            # 放大后向外多取一格作为风化的邻域，超出整张地图的部分除外
+            a0, a1 = max(i0 - 1, 0), min(i1 + 1, shape[k][0])
+            b0, b1 = max(j0 - 1, 0), min(j1 + 1, shape[k][1])
+            refined = kernels.upsample(map, cut)[a0 - cut*s0:a1 - cut*s0, b0 - cut*t0:b1 - cut*t0]
+            randmat = self.weathering_random(self.cut_times + k, b0, b1)(a0, a1)
+            map = kernels.weathering(refined, randmat, intensity, engine)[i0 - a0:i1 - a0, j0 - b0:j1 - b0]
+        map = np.array(map, dtype=self.land_dtype)
+        i0, i1, j0, j1 = bounds[-1]
+        if coastline: 
+            mask = kernels.coastline_mask(np.take(self.land_table, map), edge='land')
+            # 与 coastline(edge='skip') 一致，整张地图边缘的格点不设为海岸线
+            if i0 == 0: mask[0] = False
+            if j0 == 0: mask[:, 0] = False
+            if i1 == shape[-1][0]: mask[-1] = False
+            if j1 == shape[-1][1]: mask[:, -1] = False
+            map[mask] = self.land_index_dict['边界']
+        return map[top - i0:bottom - i0, left - j0:right - j0]
+
+    def coastline(self, connectivity=4, thickness=1, edge='skip', inplace=False): 
+        """生成海岸线，参数含义见 kernels.coastline_mask，inplace=True 时直接修改当前地图"""
+        new_map = self.map if inplace else self.map.copy()
+        self.executor.coastline(new_map, self.land_table, self.land_index_dict['边界'], connectivity, thickness, edge)
+        self.map  = new_map
+        self.land = None
         self.changed = True
 
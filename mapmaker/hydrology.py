@@ -0,0 +1,165 @@
+"""
+按高度图自动生成河流
+
+高度不超过海平面的格点和地图边缘的格点为出口。先用 priority-flood 填平洼地：以相邻两格的较大高度为边权，
+所有出口连向一个虚拟根节点，从根出发的最小生成树即 priority-flood 的访问树，每格填平后的高度为树上路径中的最大高度。
+再在填平后的高度上按 D8（八邻域最陡下降）确定流向，没有更低邻格的平地和填平的洼地沿访问树流向出口。
+最小生成树和广度优先遍历使用 scipy.sparse.csgraph，复杂度为 O(n log n)，之后按树的层逐层整体计算。
+格点下标均为展平后的下标，流向 -1 表示出口。
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, minimum_spanning_tree
+
+from .randombase import hash_key, streams
+from .render import to_point
+from .unit import River, randomize_rivers
+
+
+offsets = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+halves  = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def tree_levels(order, parent):
+    """
+    广度优先顺序 order 中各层的边界，order[0] 为根，第 k 层为 order[bounds[k]:bounds[k+1]]
+
+    广度优先遍历中父节点的位置随子节点单调不减，因此每层的结束位置可由二分查找得到。
+    """
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+    parent_position = position[parent[order[1:]]]
+    bounds = [0]
+    while bounds[-1] < len(order): 
+        bounds.append(int(np.searchsorted(parent_position, bounds[-1])) + 1)
+    return bounds
+
+
+def priority_flood(altitude, sea_level=0.0):
+    """填平洼地，返回 (填平后的高度, 访问树中各格的父格点)"""
+    z      = np.asarray(altitude, dtype=float)
+    rows, cols = z.shape
+    n      = z.size
+    flat   = z.reshape(-1)
+    land   = z > sea_level
+    index  = np.arange(n, dtype=np.int64).reshape(rows, cols)
+    # csgraph 不使用权为 0 的边，高度整体平移为正数，海洋与根之间的边权最小
+    height = z - z.min() + 1.0
+    edge   = np.zeros((rows, cols), dtype=bool)
+    edge[[0, -1]] = edge[:, [0, -1]] = True
+    outlet = np.flatnonzero(~land | edge)
+    u, v   = [outlet], [np.full(len(outlet), n)]
+    w      = [np.where(land.reshape(-1)[outlet], height.reshape(-1)[outlet], 0.5)]
+    for di, dj in halves: 
+        a    = slice(0, rows - di), slice(max(-dj, 0), cols - max(dj, 0))
+        b    = slice(di, rows), slice(max(dj, 0), cols - max(-dj, 0))
+        keep = land[a] | land[b]
+        u.append(index[a][keep])
+        v.append(index[b][keep])
+        w.append(np.maximum(height[a], height[b])[keep])
+    graph  = csr_matrix((np.concatenate(w), (np.concatenate(u), np.concatenate(v))), shape=(n + 1, n + 1))
+    tree   = minimum_spanning_tree(graph, overwrite=True)
+    order, parent = breadth_first_order(tree, n, directed=False)
+    filled = np.empty(n + 1)
+    filled[n] = -np.inf
+    bounds = tree_levels(order, parent)
+    for i0, i1 in zip(bounds[1:-1], bounds[2:]): 
+        cells = order[i0:i1]
+        filled[cells] = np.maximum(flat[cells], filled[parent[cells]])
+    parent = parent[:n].astype(np.int64)
+    parent[parent == n] = -1
+    return filled[:n].reshape(rows, cols), parent
+
+
+def flow_direction(filled, parent, sea_level=0.0):
+    """D8 流向：陆地格点流向坡度最大的更低邻格，没有更低邻格时流向访问树中的父格点，海洋为出口"""
+    rows, cols = filled.shape
+    padded   = np.pad(filled, 1, constant_values=np.inf)
+    index    = np.arange(filled.size).reshape(rows, cols)
+    receiver = parent.reshape(rows, cols).copy()
+    steepest = np.zeros((rows, cols))
+    for di, dj in offsets: 
+        slope  = (filled - padded[1+di:rows+1+di, 1+dj:cols+1+dj])/np.hypot(di, dj)
+        better = slope > steepest
+        steepest[better] = slope[better]
+        receiver[better] = index[better] + di*cols + dj
+    receiver[filled <= sea_level] = -1
+    return receiver.reshape(-1)
+
+
+def flow_accumulation(receiver):
+    """各格的汇流累积量（上游格点数，含自身）和沿流向到出口的格点数，形状均与 receiver 相同"""
+    n      = len(receiver)
+    source = np.arange(n)
+    target = np.where(receiver < 0, n, receiver)
+    graph  = csr_matrix((np.ones(n), (target, source)), shape=(n + 1, n + 1))
+    order, parent = breadth_first_order(graph, n, directed=True)
+    bounds = tree_levels(order, parent)
+    levels = list(zip(bounds[1:-1], bounds[2:]))
+    accumulation = np.ones(n + 1)
+    distance     = np.zeros(n + 1, dtype=np.int64)
+    for k, (i0, i1) in enumerate(levels): 
+        distance[order[i0:i1]] = k
+    for i0, i1 in reversed(levels[1:]): 
+        # 同一父节点的子节点在广度优先顺序中相邻，按段求和
+        cells  = order[i0:i1]
+        up     = parent[cells]
+        starts = np.flatnonzero(np.r_[True, up[1:] != up[:-1]])
+        accumulation[up[starts]] += np.add.reduceat(accumulation[cells], starts)
+    return accumulation[:n], distance[:n]
+
+
+def trace_rivers(receiver, channel, distance, min_length=2):
+    """
+    将河道格点 channel 分解为河流，返回各条河流经过的格点下标数组
+
+    从没有上游河道的河源出发，按到出口的距离从远到近依次沿流向追踪，到达出口、海洋或已有河流时停止，
+    汇入其他河流的支流包含汇入点。格点数少于 min_length 的河流不保留。
+    """
+    n     = len(receiver)
+    inner = channel & (receiver >= 0)
+    up    = np.bincount(receiver[inner], minlength=n)
+    heads = np.flatnonzero(channel & (up == 0))
+    heads = heads[np.argsort(-distance[heads], kind='stable')]
+    claimed = np.zeros(n, dtype=bool)
+    paths   = []
+    for cell in heads.tolist(): 
+        path = [cell]
+        while True: 
+            claimed[cell] = True
+            cell = int(receiver[cell])
+            if cell < 0: break
+            path.append(cell)
+            if claimed[cell] or not channel[cell]: break
+        if len(path) >= min_length: paths.append(np.array(path))
+    return paths
+
+
+def generate_rivers(altitude, range, threshold=None, spacing=8, min_length=None, sea_level=0.0, 
+    seed=0, delta_length=1, intensity=0.5, legacy=None):
+    """
+    按高度图生成河流，range=[left, right, bottom, top] 为高度图对应的绘图范围
+
+    汇流累积量不少于 threshold（默认为陆地格点数的千分之一）的陆地格点为河道，河流的关键点为流经格点中心每隔
+    spacing 格取一点（含起点和终点），关键点之间按中点位移生成曲线。河流的随机种子由 seed 和河流编号决定。
+    返回 River 列表，名称为 'river <编号>'。
+    """
+    altitude = np.asarray(altitude, dtype=float)
+    if threshold is None: threshold = max(int((altitude > sea_level).sum()) // 1000, 2)
+    if min_length is None: min_length = spacing + 1
+    filled, parent = priority_flood(altitude, sea_level)
+    receiver = flow_direction(filled, parent, sea_level)
+    accumulation, distance = flow_accumulation(receiver)
+    channel  = (accumulation >= threshold) & (altitude.reshape(-1) > sea_level)
+    rivers, jobs = [], []
+    for i, path in enumerate(trace_rivers(receiver, channel, distance, min_length)): 
+        keep = np.unique(np.r_[np.arange(0, len(path), spacing), len(path) - 1])
+        rows, cols = np.divmod(path[keep], altitude.shape[1])
+        river = River(name=f'river {i+1}', seed=hash_key(seed, streams['river'], i) % 2**31 + 1, 
+            delta_length=delta_length, intensity=intensity, legacy=legacy)
+        river.keypoints = np.array(to_point(rows + 0.5, cols + 0.5, range, altitude.shape)).tolist()
+        rivers.append(river)
+        jobs.append((river, *river.segment_ends(), None))
+    randomize_rivers(jobs)
+    return rivers
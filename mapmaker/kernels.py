@@ -0,0 +1,122 @@
+"""
+地图逐格运算的核函数，安装 numba 时可使用编译版本
+"""
+
+import numpy as np
+from scipy.ndimage import binary_erosion, generate_binary_structure
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+engines = ('auto', 'numpy', 'numba')
+edges   = ('skip', 'land', 'sea')
+numba_threshold = 10**7
+
+
+def weathering_numpy(map, randmat, intensity, i0=0, i1=None, out=None):
+    """
+    风化核函数，内部格点按随机数取上下或左右相邻格点的地块，左右平移优先
+
+    只计算第 i0 到 i1 行并写入 out 的对应行，randmat 为这些行的随机数，形状为 (i1-i0, cols, 2)。
+    """
+    rows = map.shape[0]
+    if i1 is None: i1 = rows
+    if out is None: out = np.empty_like(map)
+    out[i0:i1] = map[i0:i1]
+    lo = max(i0, 1)
+    hi = min(i1, rows-1)
+    if lo >= hi: return out
+    center  = map[lo:hi, 1:-1]
+    down    = randmat[lo-i0:hi-i0, 1:-1, 0]
+    right   = randmat[lo-i0:hi-i0, 1:-1, 1]
+    result  = np.where(down > 1 - intensity,  map[lo+1:hi+1, 1:-1],
+              np.where(down < intensity,      map[lo-1:hi-1, 1:-1], center))
+    result  = np.where(right > 1 - intensity, map[lo:hi, 2:],
+              np.where(right < intensity,     map[lo:hi, :-2], result))
+    out[lo:hi, 1:-1] = result
+    return out
+
+
+if njit is not None:
+    @njit(cache=True)
+    def weathering_loop(map, randmat, intensity, i0, i1, out):
+        rows, cols = map.shape
+        out[i0:i1] = map[i0:i1]
+        for i in range(max(i0, 1), min(i1, rows-1)):
+            k = i - i0
+            for j in range(1, cols-1):
+                if randmat[k,j,0] > 1 - intensity:
+                    out[i,j] = map[i+1, j]
+                elif randmat[k,j,0] < intensity:
+                    out[i,j] = map[i-1, j]
+                if randmat[k,j,1] > 1 - intensity:
+                    out[i,j] = map[i, j+1]
+                elif randmat[k,j,1] < intensity:
+                    out[i,j] = map[i, j-1]
+        return out
+else:
+    weathering_loop = None
+
+
+def choose_engine(size):
+    """安装 numba 且格点数不少于 numba_threshold 时使用编译版本"""
+    return 'numba' if weathering_loop is not None and size >= numba_threshold else 'numpy'
+
+
+def weathering(map, randmat, intensity, engine='auto', i0=0, i1=None, out=None):
+    """按 engine 选择风化实现，'auto' 见 choose_engine，参数含义见 weathering_numpy"""
+    if engine == 'auto': engine = choose_engine(map.size)
+    if engine == 'numpy':
+        return weathering_numpy(map, randmat, intensity, i0, i1, out)
+    elif engine == 'numba':
+        if weathering_loop is None:
+            raise ImportError("engine='numba' requires numba to be installed.")
+        if i1 is None: i1 = map.shape[0]
+        if out is None: out = np.empty_like(map)
+        return weathering_loop(map, randmat, intensity, i0, i1, out)
+    else:
+        raise ValueError(f"Unknown engine '{engine}', choose from {engines}.")
+
+
+def coastline_mask(land, connectivity=4, thickness=1, edge='skip'):
+    """
+    海岸线掩码：与非陆地的距离不超过 thickness 的陆地格点
+
+    connectivity 为 4 时只看上下左右相邻格点，为 8 时包括对角格点。
+    edge 决定地图外侧的处理：
+        'skip' 外侧视为陆地，且最外一圈格点不标记（与逐格扫描的旧结果一致）
+        'land' 外侧视为陆地
+        'sea'  外侧视为海洋，最外一圈陆地均为海岸线
+    """
+    if connectivity not in (4, 8):
+        raise ValueError(f"connectivity must be 4 or 8, got {connectivity}.")
+    if edge not in edges:
+        raise ValueError(f"Unknown edge '{edge}', choose from {edges}.")
+    structure = generate_binary_structure(2, 1 if connectivity == 4 else 2)
+    inner     = binary_erosion(land, structure, iterations=thickness, border_value=(edge != 'sea'))
+    mask      = land & ~inner
+    if edge == 'skip':
+        mask[[0, -1], :] = False
+        mask[:, [0, -1]] = False
+    return mask
+
+
+def upsample_view(map, cut):
+    """
+    最近邻放大的惰性视图，形状为 (rows, cut, cols, cut)，不复制数据
+    
+    view[i, a, j, b] 即放大后第 cut*i+a 行、第 cut*j+b 列的地块。
+    """
+    rows, cols = map.shape
+    return np.broadcast_to(map[:, None, :, None], (rows, cut, cols, cut))
+
+
+def upsample(map, cut, out=None):
+    """最近邻放大 cut 倍，直接写入与 map 同类型的数组 out（可预先分配）"""
+    rows, cols = map.shape
+    if out is None: out = np.empty((cut*rows, cut*cols), dtype=map.dtype)
+    out.reshape(rows, cut, cols, cut)[...] = upsample_view(map, cut)
+    return out
@@ -1,27 +1,51 @@
 import os
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from . import hydrology, pyramid, storage
 from .coloring import ChangeableMap
-from .unit import City, River
+from .render import (ImageCache, city_color, marker_pixels, polyline_pixels, render, river_color, 
+    to_cell, write_indexed_png)
+from .spatial import SpatialIndex
+from .unit import Cities, River, change_rivers
 
-plt.rcParams["font.sans-serif"] = ["SimHei"]  #设置字体
-plt.rcParams["axes.unicode_minus"] = False    #该语句解决图像中的“-”负号的乱码问题
+try: 
+    import matplotlib.pyplot as plt
+except ImportError:   #无 matplotlib 时仍可生成地图和图像数组，但无法绘图
+    plt = None
+else: 
+    plt.rcParams["font.sans-serif"] = ["SimHei"]  #设置字体
+    plt.rcParams["axes.unicode_minus"] = False    #该语句解决图像中的“-”负号的乱码问题
 
 
 class Map(ChangeableMap): 
     """可绘制的，包含城市和河流绘制和指派的地图对象"""
     def __init__(
         self, map=None, cut_time=0, data_path='data', name=None,
-        cities=True, rivers=True, seed=None
+        cities=True, rivers=True, seed=None, lazy=False, legacy=None, save=True
     ): 
-        super().__init__(map, seed, cut_time)
+        """
+        lazy=True 时从磁盘内存映射读取地图，不重新保存地图数据，
+        陆地掩码和图像在首次使用时才生成；save=False 时创建地图时不保存地图数据（如之后马上 polish）；
+        legacy=True 时使用旧版本的全局随机状态，见 RandomBase
+        """
+        super().__init__(map, seed, cut_time, lazy, legacy)
+        self.image_cache = ImageCache(self.palette)
+        self.pyramid_source = None
         self.set_files(data_path, name)
-        self.save_map_data()
+        self.load_altitude()
+        if lazy: 
+            self.load_pyramid()
+        elif save: 
+            self.save_map_data()
+        self.cities, self.rivers = Cities(), []
+        self.river_index = SpatialIndex()
         if cities: self.read_cities()
         if rivers: self.read_rivers()
-        self.__generate_image()
+        if lazy: 
+            self.changed = True
+        else: 
+            self.__generate_image()
         self.set_figure()
     
     def __repr__(self): 
@@ -37,9 +61,9 @@ class Map(ChangeableMap):
             m = Map('{self.map_file}', name='{self.name}', cut_time={self.cut_times}, seed='{self.seed}')
         """
 
-    def set_files(self, data_path, name, map_file='map.txt', altitude_file='altitude.txt', 
-        city_file='city.txt', river_file='river_name.txt'):
-        """设置数据储存路径"""
+    def set_files(self, data_path, name, map_file='map.npy', altitude_file='altitude.npy', 
+        city_file='city.npy', river_file='river_name.txt', meta_file='meta.json'):
+        """设置数据储存路径，旧版文本数据将自动转换为 .npy 文件"""
         if not name: 
             self.name = '未命名'
         else: 
@@ -50,50 +74,93 @@ class Map(ChangeableMap):
         self.altitude_file = self.path + '/' + altitude_file
         self.city_file     = self.path + '/' + city_file
         self.river_file    = self.path + '/' + river_file
-        open(self.city_file,  'a').close()
+        self.meta_file     = self.path + '/' + meta_file
         open(self.river_file, 'a').close()
+        storage.migrate(self.path)
 
     def save_map_data(self): 
-        np.savetxt(self.map_file, self.map, delimiter=', ', fmt='%d')
-        np.savetxt(self.altitude_file, self.altitude_map, delimiter=', ')
+        storage.save_array(self.map_file, self.map)
+        if self.altitude_map.size > 0: storage.save_array(self.altitude_file, self.altitude_map)
+        self.save_pyramid()
+        self.save_meta()
+    
+    def save_pyramid(self, min_size=256): 
+        """保存地图金字塔 map_<k>.npy，见 pyramid 模块"""
+        files = pyramid.save(self.path, self.map, min_size)
+        self.pyramid        = {0: self.map, **{k+1: storage.load_array(file) for k, file in enumerate(files)}}
+        self.pyramid_source = self.map
+    
+    def load_pyramid(self): 
+        """内存映射读取已保存的地图金字塔，比 map.npy 旧或尺寸不符的层不使用"""
+        self.pyramid        = {0: self.map}
+        self.pyramid_source = self.map
+        if not os.path.exists(self.map_file): return
+        for k, file in pyramid.levels(self.path).items(): 
+            level = storage.load_array(file)
+            shape = tuple(-(-n // 2**k) for n in self.map.shape)
+            if k - 1 not in self.pyramid or level.shape != shape \
+                or os.path.getmtime(file) < os.path.getmtime(self.map_file): 
+                break
+            self.pyramid[k] = level
+    
+    def level(self, k): 
+        """地图金字塔的第 k 层，第 0 层为地图本身；地图改变后重新计算"""
+        if self.pyramid_source is not self.map: 
+            self.pyramid        = {0: self.map}
+            self.pyramid_source = self.map
+        for i in range(1, k + 1): 
+            if i not in self.pyramid: self.pyramid[i] = pyramid.mode_downsample(self.pyramid[i-1])
+        return self.pyramid[k]
+    
+    def thumbnail(self, size=256): 
+        """长边不小于 size 的最小一层金字塔的 RGB 图像"""
+        scale = size / max(self.map.shape)
+        k = pyramid.choose_level(self.map.shape, (scale*self.rows, scale*self.cols), 
+            int(np.log2(max(self.map.shape))))
+        return render(self.level(k), self.palette)
+    
+    def load_altitude(self): 
+        """地图中没有高度数据时，内存映射读取已保存的高度图"""
+        if self.altitude_map.size == 0 and os.path.exists(self.altitude_file): 
+            self.altitude_map = storage.load_array(self.altitude_file)
+    
+    def save_meta(self): 
+        """保存生成参数"""
+        storage.save_meta(self.meta_file, 
+            name=self.name, seed=self.seed, cut_times=self.cut_times, 
+            rows=int(self.rows), cols=int(self.cols), range=[float(x) for x in self.range])
 
     def read_cities(self): 
         """从文件中读取城市数据"""
-        self.cities = []
-        if os.path.getsize(self.city_file) > 0: 
-            lst      = pd.read_csv(self.city_file, sep=',', header=None).values
-            name     = lst[:,0].tolist()
-            location = lst[:,1:3].tolist()
-            self.cities = [City(location[i], name[i]) for i in range(len(name))]
-        else: 
-            print(f"File '{self.city_file}' is empty.")
+        self.cities = Cities.load(self.city_file)
+        if len(self.cities) == 0: print(f"File '{self.city_file}' is empty.")
     
-    def set_city(self, city_name, city_location): 
+    def set_city(self, city_name, city_location, population=0): 
         """设置新城市，需给定城市名和位置"""
-        c = City(city_location, city_name)
-        self.cities.append(c)
-        f = open(self.city_file, 'a')
-        f.write(f'{c.name}, {c.location[0]}, {c.location[1]} \n')
-        f.close()
+        self.add_cities([city_name], [city_location[0]], [city_location[1]], [population])
+    
+    def add_cities(self, names, x, y, population=None): 
+        """批量设置新城市，names, x, y, population 为等长序列，加入后一次写入文件"""
+        self.cities.add(names, x, y, population)
+        self.cities.save(self.city_file)
+    
+    def remove_cities(self, names): 
+        """批量清除给定名称的城市，删除后一次写入文件"""
+        if self.cities.remove(names): self.cities.save(self.city_file)
     
     def clear_all_city(self):
         """清除所有城市"""
-        self.cities = []
-        open(self.city_file, 'w').close()
+        self.cities = Cities()
+        self.cities.save(self.city_file)
     
     def clear_city(self, *city_names): 
         """清除给定城市"""
-        for c in self.cities: 
-            if c.name in city_names: self.cities.remove(c)
-        cities = self.cities
-        self.clear_all_city()
-        for c in cities:
-            self.set_city(c.name, c.location)
+        self.remove_cities(city_names)
     
     def rename_city(self, old_name, new_name): 
         """重命名城市"""
-        for c in self.cities: 
-            if c.name in old_name: c.name = new_name
+        self.cities.rename(old_name, new_name)
+        self.cities.save(self.city_file)
     
     def read_rivers(self): 
         """从文件中读取河流"""
@@ -101,34 +168,64 @@ class Map(ChangeableMap):
         if os.path.getsize(self.river_file) > 0: 
             names = pd.read_csv(self.river_file, header=None).values.reshape(-1).tolist()
             for name in names: 
-                file = self.path + '/' + name + '.txt'
-                if os.path.getsize(file) > 0: 
-                    r        = River(name=name)
-                    r.points = pd.read_csv(file, sep=',', header=None).values.tolist()
-                    self.rivers.append(r)
+                file = self.path + '/' + name + '.npy'
+                if os.path.exists(file): 
+                    self.rivers.append(River(name=name, legacy=self.legacy).load(file))
         else: 
             print(f"File '{self.river_file}' is empty.")
+        self.river_index.clear()
+        for r in self.rivers: self.river_index.add(r, r.points)
     
     def set_river(self, river_name, keypoints): 
         """设置新河流，给定河流名和流经关键点"""
-        r = River(keypoints, name=river_name, delta_length=1/2**self.cut_times)
+        r = River(keypoints, name=river_name, delta_length=1/2**self.cut_times, legacy=self.legacy)
         r.save(self.path)
         f = open(self.river_file, 'a')
         name = river_name + '\n'
         f.write(name)
         f.close()
         self.rivers.append(r)
+        self.river_index.add(r, r.points)
+    
+    def add_rivers(self, rivers): 
+        """批量加入河流，重名的河流按默认方式重新命名，河流名一次追加写入文件"""
+        taken = []
+        for r in rivers: 
+            if r.name in taken or any(old.name == r.name for old in self.rivers): 
+                r.name = self.__default_name('river', taken)
+            taken.append(r.name)
+            r.save(self.path)
+            self.river_index.add(r, r.points)
+        with open(self.river_file, 'a') as f: 
+            f.write(''.join(r.name + '\n' for r in rivers))
+        self.rivers += list(rivers)
+    
+    def generate_rivers(self, threshold=None, spacing=8, min_length=None, cover=False): 
+        """
+        按高度图自动生成河流，见 hydrology 模块，cover=True 时先清除已有河流，返回新生成的河流列表
+
+        threshold 为河源处的汇流格点数（按高度图格点计），默认为陆地格点数的千分之一；
+        spacing 为关键点间隔的格点数，流经格点数少于 min_length 的河流不保留。
+        """
+        if self.altitude_map.size == 0: 
+            raise ValueError('generate_rivers requires a map created from an altitude map.')
+        if cover: self.clear_all_river()
+        rivers = hydrology.generate_rivers(self.altitude_map, self.range, threshold, spacing, min_length, 
+            seed=self.seed, delta_length=1/2**self.cut_times, legacy=self.legacy)
+        self.add_rivers(rivers)
+        return rivers
     
     def clear_all_river(self): 
         """清除所有河流"""
         self.rivers = []
+        self.river_index.clear()
         open(self.river_file, 'w').close()
     
     def clear_river(self, *river_names): 
         """清除给定河流，如不给定参数则删除最后一条河流"""
         if not river_names: river_names = (self.rivers[-1].name, )
-        for r in self.rivers:
-            if r.name in river_names: self.rivers.remove(r)
+        self.river_index.remove(*[r for r in self.rivers if r.name in river_names])
+        self.rivers = [r for r in self.rivers if r.name not in river_names]
         rivers = self.rivers
         f = open(self.river_file, 'w')
         for r in rivers:
@@ -136,22 +233,76 @@ class Map(ChangeableMap):
             f.write(river_name)
         f.close()
     
-    def change_river(self, *river_names): 
-        """微调河流形状，如不给定参数则微调所有河流"""
+    def change_river(self, *river_names, segments=None): 
+        """
+        微调河流形状，如不给定参数则微调所有河流；segments 为要微调的线段编号，默认为全部线段
+
+        只重新生成给定的线段，并只保存改变的河流。
+        """
+        rivers = [r for r in self.rivers if (not river_names) or (r.name in river_names)]
+        change_rivers(rivers, segments)
+        for r in rivers: 
+            r.save(self.path)
+            self.river_index.add(r, r.points)
+    
+    def add_river_point(self, river_name, x, y): 
+        """在河流末尾增加关键点，只生成新增的一段线段并保存该河流"""
         for r in self.rivers: 
-            if (not river_names) or (r.name in river_names): 
-                r.full_random()
-                r.save()
-        self.read_rivers()
+            if r.name == river_name: 
+                r.add_point(x, y)
+                r.save(self.path)
+                self.river_index.add(r, r.points)
+    
+    def cities_near(self, x, y, radius): 
+        """与点 (x, y) 距离不超过 radius 的城市，按距离从近到远排列"""
+        return self.cities.take(self.cities.within(x, y, radius))
+    
+    def nearest_cities(self, x, y, k=1): 
+        """距离点 (x, y) 最近的 k 个城市"""
+        return self.cities.take(self.cities.nearest(x, y, k))
+    
+    def cities_in(self, left, right, bottom, top): 
+        """位于矩形范围内的城市"""
+        return self.cities.take(self.cities.in_box(left, right, bottom, top))
+    
+    def cities_near_river(self, river_name, radius): 
+        """与给定河流距离不超过 radius 的城市"""
+        points = [r.points for r in self.rivers if r.name == river_name]
+        return self.cities.take(self.cities.near(np.concatenate([np.zeros((2, 0)), *points], axis=1), radius))
+    
+    def rivers_near(self, x, y, radius): 
+        """与点 (x, y) 距离不超过 radius 的河流，按距离从近到远排列"""
+        return self.river_index.within(x, y, radius)
+    
+    def rivers_in(self, left, right, bottom, top): 
+        """流经矩形范围的河流"""
+        return self.river_index.in_box(left, right, bottom, top)
+    
+    def cities_on(self, *landtypes): 
+        """位于给定地块（如 '山地'）上的城市，按城市所在格点整体查表"""
+        if len(self.cities) == 0: return []
+        rows, cols = to_cell(self.cities.x, self.cities.y, self.range, self.map.shape)
+        rows   = np.floor(rows).astype(np.int64)
+        cols   = np.floor(cols).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.map.shape[0]) & (cols >= 0) & (cols < self.map.shape[1])
+        table  = self.lookup_table(landtypes, inside=True, outside=False)
+        on     = np.zeros(len(self.cities), dtype=bool)
+        on[inside] = table[self.map[rows[inside], cols[inside]]]
+        return self.cities.take(np.flatnonzero(on))
+    
+    @property
+    def image(self): 
+        """地图的 RGB 图像，地图改变后首次访问时重新生成"""
+        if self.changed: self.__generate_image()
+        return self.image_cache.image
     
     def __generate_image(self): 
-        self.image   = self.__convert2image(self.map)
+        self.image_cache(self.map)
         self.changed = False
     
     def __convert2image(self, map):
-        lst = [self.color_dict[landtype] for landtype in self.index_land_dict.values()]
-        if type(map) == np.ndarray: 
-            return np.array(np.vectorize(lambda x: lst[x])(map)).transpose(1,2,0)
+        if isinstance(map, np.ndarray): 
+            return render(map, self.palette)
 
     def set_figure(self, width=20, dpi=72): 
         """设置图片尺寸和分辨率"""
@@ -163,8 +314,7 @@ class Map(ChangeableMap):
         title=None, river=True,  city=True, grid=False, axis=True, save=True): 
         """画地图"""
         if not which: 
-            if self.changed: self.__generate_image()
-            image = self.image
+            image = self.__plot_image(width, height, dpi)
             if not title: title = self.name + '地图'
         else: 
             if which == '原图': 
@@ -191,6 +341,34 @@ class Map(ChangeableMap):
             plt.savefig(name)
         plt.show()
 
+    def __plot_image(self, width, height, dpi): 
+        # 按图片的像素尺寸选用金字塔中的一层，不需要时不处理完整分辨率的地图
+        width, height = self.__set_figsize(width, height)
+        if not dpi: dpi = self.figdpi
+        k = pyramid.choose_level(self.map.shape, (height*dpi, width*dpi), 
+            int(np.log2(max(self.map.shape))))
+        if k == 0: return self.image
+        return render(self.level(k), self.palette)
+
+    def export(self, file=None, river=True, city=True, river_width=1, city_size=7, level=6): 
+        """
+        不经过 matplotlib，将地图按每个格点一个像素直接写为索引色 PNG，河流和城市直接画入图像
+
+        默认保存为 data/<地图名>/<地图名>.png，返回文件路径。地图按行分块压缩写入，lazy 模式下不读入整张地图。
+        """
+        if file is None: file = self.path + '/' + self.name + '.png'
+        shape    = self.map.shape
+        palette  = np.vstack([self.palette, [river_color, city_color]])
+        overlays = []
+        if river: 
+            for r in self.rivers: 
+                rows, cols = to_cell(*r.points, self.range, shape)
+                overlays.append((*polyline_pixels(rows, cols, shape, river_width), len(self.palette)))
+        if city and len(self.cities) > 0: 
+            rows, cols = to_cell(self.cities.x, self.cities.y, self.range, shape)
+            overlays.append((*marker_pixels(rows, cols, shape, city_size), len(self.palette) + 1))
+        return write_indexed_png(file, self.map, palette, overlays, level)
+
     def __check_name(self, name):
         new_name = name
         for s in ('<', '>', '/', '\\', '|', ':', '*', '?', ' ', '.'):
@@ -209,12 +387,12 @@ class Map(ChangeableMap):
 
     def __plot_city(self, figwidth, city_name=True): 
         if len(self.cities) > 0: 
-            location = np.array([c.location for c in self.cities]).T
-            plt.scatter(*location, c='m', marker='*', zorder=3)
+            plt.scatter(self.cities.x, self.cities.y, c='m', marker='*', zorder=3)
             fontsize = int(0.5*figwidth)
             if fontsize < 10: fontsize = 10
-            for c in self.cities: 
-                if city_name: plt.annotate(f'{c.name}', xy=c.location, xytext=c.location, fontsize=fontsize)
+            if city_name: 
+                for name, x, y in zip(self.cities.names.tolist(), self.cities.x.tolist(), self.cities.y.tolist()): 
+                    plt.annotate(f'{name}', xy=(x, y), xytext=(x, y), fontsize=fontsize)
     
     def __plot_river(self, figwidth): 
         for r in self.rivers: 
@@ -257,10 +435,10 @@ class Map(ChangeableMap):
 
     def __pick_city(self, cover): 
         if cover: self.clear_all_city()
-        lst = plt.ginput(-1, timeout = -1)
-        for position in lst: 
-            name = self.__default_name('city')
-            self.set_city(name, position)
+        lst   = plt.ginput(-1, timeout = -1)
+        names = []
+        for _ in lst: names.append(self.__default_name('city', names))
+        self.add_cities(names, [x for x, _ in lst], [y for _, y in lst])
     
     def __pick_river(self, cover): 
         if cover: self.clear_all_river()
@@ -269,11 +447,12 @@ class Map(ChangeableMap):
         name   = self.__default_name('river')
         self.set_river(name, points)
 
-    def __default_name(self,unit):
+    def __default_name(self, unit, taken=()):
         if unit == 'city': 
-            all_names = [c.name for c in self.cities]
+            all_names = set(self.cities.names.tolist())
         elif unit == 'river': 
-            all_names = [r.name for r in self.rivers]
+            all_names = set(r.name for r in self.rivers)
+        all_names.update(taken)
         new_name = unit + ' 1'
         for i, _ in enumerate(all_names): 
             if new_name not in all_names: break
@@ -284,8 +463,25 @@ class Map(ChangeableMap):
         super().extract_layer(*layer_names)
         if plot: self.plot(which='提取', title=f'地块绘图（包括{layer_names}）')
     
-    def polish(self, times=1, assign_plant=True, detail=False, history=True): 
-        """自动细化地图"""
+    def __record_history(self, i, map, history, copy, preview_size): 
+        if history == 'preview': 
+            step = -(-max(map.shape) // preview_size)
+            self.polish_history[i] = map[::step, ::step].copy()
+        elif history == 'compressed': 
+            self.polish_history[i] = storage.CompressedArray(map)
+        elif history: 
+            self.polish_history[i] = map.copy() if copy else map
+    
+    def polish(self, times=1, assign_plant=True, detail=False, history=True, workers=None, 
+        fused=False, preview_size=256): 
+        """
+        自动细化地图，workers 为多线程分块计算的线程数
+
+        history 为 True 时保存每轮的地图，为 'preview' 时只保存长边不超过 preview_size 的缩略图，
+        为 'compressed' 时压缩保存，为 False 时不保存。
+        fused=True 时使用 fused_polish 合并计算各轮放大和风化，以减少内存占用（detail=True 时无效）。
+        """
+        if workers: self.executor.workers = workers
         if detail: self.plot(
                 title = f'Origin map: (size: {self.rows} x {self.cols})', 
                 width = 5, river = False, city = False, save=False
@@ -296,15 +492,22 @@ class Map(ChangeableMap):
                 title = f'Planted map: (size: {self.rows} x {self.cols})', 
                 width = 5, river = False, city = False, save=False
             )
-        if history: self.polish_history = {0: self.map}
-        for i in range(times): 
-            self.refine()
-            self.weathering()
-            if detail: self.plot(
-                title = f'Polish time: {i+1} (size: {self.rows} x {self.cols})', 
-                width = 5, river = False, city = False, save=False
-            )
-            if history: self.polish_history[i+1] = self.map
-        self.coastline()
-        np.savetxt(self.map_file, self.map, delimiter=', ', fmt='%d')
+        if history: self.polish_history = {}
+        record = lambda i, map: self.__record_history(i, map, history, fused, preview_size)
+        record(0, self.map)
+        if fused and not detail: 
+            self.fused_polish(times, record=record)
+        else: 
+            for i in range(times): 
+                self.refine()
+                self.weathering()
+                if detail: self.plot(
+                    title = f'Polish time: {i+1} (size: {self.rows} x {self.cols})', 
+                    width = 5, river = False, city = False, save=False
+                )
+                record(i+1, self.map)
+        self.coastline(inplace=fused or history is not True)
+        storage.save_array(self.map_file, self.map)
+        self.save_pyramid()
+        self.save_meta()
 
@@ -1,30 +1,58 @@
 import numpy as np
-from numpy import random
 
 from .randombase import RandomBase
 
 
 class Perlin2d(RandomBase):
-    def __init__(self, cells=(1,1), seed=None):
-        super().__init__(seed)
+    """二维柏林噪声，mode='array' 时整体向量化计算，mode='point' 时逐点计算"""
+    def __init__(self, cells=(1,1), seed=None, mode='array', rng=None, legacy=None):
+        super().__init__(seed, rng, legacy)
         self.perlin_cells = tuple(cells)
+        self.mode         = mode
     
     def __call__(self, X, Y):
         self.generate_perlin_noise(X,Y)
         return self.noise
     
     def generate_perlin_noise(self, X, Y):
-        xmin = X.min()
-        xmax = X.max()
-        ymin = Y.min()
-        ymax = Y.max()
-        Xr   = (X - xmin)/(xmax - xmin) * self.perlin_cells[0]
-        Yr   = (Y - ymin)/(ymax - ymin) * self.perlin_cells[1]
-        randmat    = random.rand(2, self.perlin_cells[0]+2, self.perlin_cells[1]+2)
+        self.generate_gradient()
+        self.noise = self.evaluate(X, Y, (X.min(), X.max(), Y.min(), Y.max()))
+    
+    def generate_gradient(self):
+        """随机生成格点梯度"""
+        randmat    = self.rng.random((2, self.perlin_cells[0]+2, self.perlin_cells[1]+2))
         self.gradx = randmat[0] * np.cos(2*np.pi * randmat[1])
         self.grady = randmat[0] * np.sin(2*np.pi * randmat[1])
-        self.noise = np.vectorize(self.__point_altitude)(Xr,Yr)
-        
+    
+    def evaluate(self, X, Y, bounds):
+        """以 bounds=(xmin, xmax, ymin, ymax) 为整体范围，计算 X, Y 处的噪声，可用于分块计算"""
+        xmin, xmax, ymin, ymax = bounds
+        Xr   = (X - xmin)/(xmax - xmin) * self.perlin_cells[0]
+        Yr   = (Y - ymin)/(ymax - ymin) * self.perlin_cells[1]
+        if self.mode == 'point':
+            return np.vectorize(self.__point_altitude)(Xr,Yr)
+        else:
+            return self.grid_altitude(Xr,Yr)
+    
+    def grid_altitude(self, Xr, Yr):
+        """整体计算网格上的噪声，结果与逐点计算一致"""
+        x0 = Xr.astype(np.int64)
+        y0 = Yr.astype(np.int64)
+        x1 = x0 + 1
+        y1 = y0 + 1
+        dx0 = Xr - x0
+        dy0 = Yr - y0
+        dx1 = Xr - x1
+        dy1 = Yr - y1
+        wx = self.__fade_grid(dx0)
+        wy = self.__fade_grid(dy0)
+        gx = self.gradx
+        gy = self.grady
+        return (1-wx)*(1-wy)*(gx[x0,y0]*dx0 + gy[x0,y0]*dy0)\
+            +     wx *(1-wy)*(gx[x1,y0]*dx1 + gy[x1,y0]*dy0)\
+            +  (1-wx)*   wy *(gx[x0,y1]*dx0 + gy[x0,y1]*dy1)\
+            +     wx *   wy *(gx[x1,y1]*dx1 + gy[x1,y1]*dy1)
+    
     def __point_altitude(self, x, y):
         x0 = int(x)
         x1 = x0 + 1
@@ -37,5 +65,11 @@ class Perlin2d(RandomBase):
             +  (1-wx)*   wy *(self.gradx[x0,y1]*(x-x0) + self.grady[x0,y1]*(y-y1))\
             +     wx *   wy *(self.gradx[x1,y1]*(x-x1) + self.grady[x1,y1]*(y-y1))
     
+    def __fade_grid(self, t):
+        # 网格坐标只有少量不同取值，逐值调用 __fade 以保证与逐点计算的舍入一致
+        values, inverse = np.unique(t, return_inverse=True)
+        faded = np.array([self.__fade(v) for v in values.tolist()])
+        return faded[inverse].reshape(t.shape)
+    
     def __fade(self, t):
         return 6*t**5 - 15*t**4 + 10*t**3
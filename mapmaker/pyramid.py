@@ -0,0 +1,86 @@
+"""
+地块编号地图的多分辨率金字塔
+
+第 k 层为第 k-1 层按 2 x 2 的块取众数（出现次数最多的地块）缩小的结果，即逐级取众数，
+与直接对原图的 2^k x 2^k 块取众数不一定相同。各层保存为地图文件夹中的 map_<k>.npy，
+绘图、缩略图和瓦片服务可按所需的输出尺寸选用合适的层，而不必处理完整分辨率的地图。
+"""
+
+import os
+import re
+
+import numpy as np
+
+from . import storage
+
+
+def mode_downsample(map, band=256):
+    """
+    按 2 x 2 块取众数缩小地图，出现次数相同时取块中靠前（左上、右上、左下、右下）的地块
+
+    行数或列数为奇数时，最后一行或一列按重复自身补齐。按输出的 band 行分块计算，
+    每块只用步长为 2 的切片取出四个角，临时数组的大小只与 band 有关。
+    """
+    rows, cols = map.shape
+    out = np.empty((-(-rows // 2), -(-cols // 2)), dtype=map.dtype)
+    for i0 in range(0, out.shape[0], band):
+        i1    = min(i0 + band, out.shape[0])
+        block = map[2*i0:2*i1]
+        if block.shape[0] % 2: block = np.concatenate([block, block[-1:]])
+        if cols % 2: block = np.concatenate([block, block[:, -1:]], axis=1)
+        a, b = block[0::2, 0::2], block[0::2, 1::2]
+        c, d = block[1::2, 0::2], block[1::2, 1::2]
+        ab, ac, ad = a == b, a == c, a == d
+        bc, bd, cd = b == c, b == d, c == d
+        result = out[i0:i1]
+        result[:] = a
+        count = ab.astype(np.uint8) + ac + ad
+        for value, n in ((b, ab.astype(np.uint8) + bc + bd), (c, ac.astype(np.uint8) + bc + cd),
+            (d, ad.astype(np.uint8) + bd + cd)):
+            better = n > count
+            result[better] = value[better]
+            count[better]  = n[better]
+    return out
+
+
+def build(map, min_size=256):
+    """依次生成第 1, 2, ... 层，直到长边不超过 min_size，返回 (层号, 地图) 的生成器"""
+    k = 0
+    while max(map.shape) > min_size:
+        k  += 1
+        map = mode_downsample(map)
+        yield k, map
+
+
+def save(path, map, min_size=256, name='map'):
+    """生成金字塔并保存为 path 中的 <name>_<k>.npy，删除旧的多余层，返回保存的文件列表"""
+    files = []
+    for k, level in build(map, min_size):
+        files.append(os.path.join(path, f'{name}_{k}.npy'))
+        storage.save_array(files[-1], level)
+    for k, file in levels(path, name).items():
+        if k > len(files): os.remove(file)
+    return files
+
+
+def levels(path, name='map'):
+    """path 中已保存的各层文件，{层号: 文件}"""
+    if not os.path.exists(path): return {}
+    pattern = re.compile(re.escape(name) + r'_(\d+)\.npy$')
+    found   = {}
+    for file_name in os.listdir(path):
+        match = pattern.match(file_name)
+        if match: found[int(match.group(1))] = os.path.join(path, file_name)
+    return dict(sorted(found.items()))
+
+
+def choose_level(shape, size, count):
+    """
+    输出尺寸为 size=(行数, 列数) 时应使用的层：在前 count 层中，
+    选择行列数都不小于输出尺寸的最小一层，输出尺寸大于原图时为第 0 层
+    """
+    rows, cols = shape
+    k = 0
+    while k < count and -(-rows // 2**(k+1)) >= size[0] and -(-cols // 2**(k+1)) >= size[1]:
+        k += 1
+    return k
@@ -1,13 +1,85 @@
+import numpy as np
 from numpy import random
 
 
+streams = {'perlin': 1, 'plant': 2, 'weathering': 3, 'river': 4}
+mask64  = (1 << 64) - 1
+
+
+def mix64(x):
+    """splitmix64 的混合函数，x 为 Python 整数或 uint64 数组（原地修改）"""
+    if isinstance(x, int): 
+        x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & mask64
+        x = (x ^ (x >> 27)) * 0x94D049BB133111EB & mask64
+        return x ^ (x >> 31)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+
+def hash_key(*key):
+    """将若干非负整数混合为一个 64 位整数"""
+    h = 0
+    for k in key: h = mix64((h + 0x9E3779B97F4A7C15 + int(k)) & mask64)
+    return h
+
+
 class RandomBase:
-    def __init__(self, seed=None):
-        self.set_random_seed(seed)
+    """
+    带随机种子的对象，每个对象拥有自己的随机数生成器 self.rng，不使用全局随机状态
+
+    legacy=True 时与旧版本一样重置并使用全局 numpy.random 状态，以复现旧版本的结果，
+    但不能在多线程中使用；不给定时使用类属性 RandomBase.legacy。
+    """
+    legacy = False
 
-    def set_random_seed(self, seed=None):
-        if not seed:
-            self.seed = random.randint(10000)
+    def __init__(self, seed=None, rng=None, legacy=None):
+        if legacy is not None: self.legacy = legacy
+        self.set_random_seed(seed, rng)
+
+    def set_random_seed(self, seed=None, rng=None):
+        if seed is None:
+            if self.legacy:
+                self.seed = random.randint(10000)
+            else:
+                self.seed = int(random.default_rng().integers(10000))
         else:
             self.seed = int(seed)
-        random.seed(self.seed)
\ No newline at end of file
+        if rng is None: rng = self.make_rng(self.seed)
+        self.rng = rng
+
+    def make_rng(self, seed):
+        """按种子创建随机数生成器"""
+        if self.legacy:
+            random.seed(seed)
+            return random
+        return random.Generator(random.PCG64(seed))
+
+    def hash_random(self, stream, level, rows, cols):
+        """
+        按格点坐标哈希生成的 [0, 1) 均匀随机数，每个格点两个，形状为 (len(rows), len(cols), 2)
+
+        每个格点的随机数只由种子、stream、level 和格点坐标决定，因此可以只生成地图中的任意区域，
+        且结果与分块方式和线程数无关。两个随机数分别取自同一个 64 位哈希值的低 32 位和高 32 位。
+        """
+        base = hash_key(self.seed, streams[stream], level)
+        rows = mix64(np.asarray(rows, dtype=np.uint64) + np.uint64(base))
+        cols = mix64(np.asarray(cols, dtype=np.uint64) ^ np.uint64(mix64(base)))
+        x    = mix64(np.bitwise_xor.outer(rows, cols)).astype('<u8', copy=False)
+        x    = x.view('<u4').reshape(x.shape + (2,)).astype(np.float64)
+        x   *= 2.0**-32
+        return x
+
+    def spawn_rng(self, stream, *key, legacy_seed=None):
+        """
+        为子过程创建独立的随机数流，stream 为 streams 中的名称，key 为附加的整数编号
+
+        旧版本在子过程开始时重置全局随机状态，legacy 模式下同样以 legacy_seed（默认 self.seed）重置。
+        """
+        if self.legacy:
+            return self.make_rng(self.seed if legacy_seed is None else legacy_seed)
+        sequence = random.SeedSequence(self.seed, spawn_key=(streams[stream], *key))
+        return random.Generator(random.PCG64(sequence))
@@ -0,0 +1,160 @@
+"""
+地图渲染，不依赖 matplotlib
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+from .data.color_dict import color_dict
+
+
+river_color = (0x20, 0x5a, 0xa7)   # '#205aa7'
+city_color  = (191, 0, 191)
+
+
+def make_palette(colors=color_dict):
+    """按地块编号排列的 (地块数, 3) uint8 调色板"""
+    return np.array(list(colors.values()), dtype=np.uint8)
+
+
+def render(map, palette, out=None):
+    """用调色板将地块编号矩阵转换为 RGB 图像"""
+    return np.take(palette, map, axis=0, out=out)
+
+
+def to_cell(x, y, range, shape):
+    """将绘图坐标 (x, y) 转换为格点坐标 (行, 列)，range=[left, right, bottom, top] 为地图的绘图范围"""
+    left, right, bottom, top = range
+    return (top - np.asarray(y))/(top - bottom)*shape[0], (np.asarray(x) - left)/(right - left)*shape[1]
+
+
+def to_point(rows, cols, range, shape):
+    """将格点坐标 (行, 列) 转换为绘图坐标 (x, y)，为 to_cell 的逆变换"""
+    left, right, bottom, top = range
+    return left + np.asarray(cols)/shape[1]*(right - left), top - np.asarray(rows)/shape[0]*(top - bottom)
+
+
+def polyline_pixels(rows, cols, shape, width=1):
+    """折线经过的像素 (行, 列)，rows 和 cols 为各点的像素坐标（可为小数），只保留形状为 shape 的图像内的像素"""
+    p = np.stack([np.asarray(rows, dtype=float), np.asarray(cols, dtype=float)], axis=1)
+    a, b = p[:-1], p[1:]
+    keep = (np.minimum(a, b) < shape).all(axis=1) & (np.maximum(a, b) >= 0).all(axis=1)
+    a, b = a[keep], b[keep]
+    # 每段按像素间距取样
+    n     = np.ceil(np.abs(b - a).max(axis=1, initial=0)).astype(np.int64) + 1
+    seg   = np.repeat(np.arange(len(a)), n)
+    t     = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.repeat(np.maximum(n - 1, 1), n)
+    point = np.floor(a[seg] + (b - a)[seg]*t[:, None]).astype(np.int64)
+    return point_pixels(point[:, 0], point[:, 1], shape, width)
+
+
+def marker_pixels(rows, cols, shape, size=7):
+    """以各点为中心的十字标记覆盖的像素 (行, 列)"""
+    rows = np.floor(np.asarray(rows, dtype=float)).astype(np.int64)
+    cols = np.floor(np.asarray(cols, dtype=float)).astype(np.int64)
+    arm  = np.arange(-(size//2), size//2 + 1)
+    zero = np.zeros_like(arm)
+    rows = np.concatenate([(rows[:, None] + arm).ravel(), (rows[:, None] + zero).ravel()])
+    cols = np.concatenate([(cols[:, None] + zero).ravel(), (cols[:, None] + arm).ravel()])
+    return point_pixels(rows, cols, shape, 1 + size//4)
+
+
+def point_pixels(rows, cols, shape, width=1):
+    """各整数像素点扩展为宽 width 的方块后覆盖的像素 (行, 列)，只保留图像内的像素"""
+    offset = np.arange(width) - (width - 1)//2
+    rows, cols = np.broadcast_arrays(
+        np.asarray(rows, dtype=np.int64)[:, None, None] + offset[None, :, None], 
+        np.asarray(cols, dtype=np.int64)[:, None, None] + offset[None, None, :])
+    rows, cols = rows.ravel(), cols.ravel()
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    return rows[inside], cols[inside]
+
+
+def draw_polyline(image, rows, cols, color, width=1):
+    """在图像上画折线，见 polyline_pixels"""
+    image[polyline_pixels(rows, cols, image.shape[:2], width)] = color
+    return image
+
+
+def draw_markers(image, rows, cols, color, size=7):
+    """在图像上画十字标记，见 marker_pixels"""
+    image[marker_pixels(rows, cols, image.shape[:2], size)] = color
+    return image
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_png(image, level=6):
+    """将 (行, 列, 3) 的 uint8 RGB 图像编码为 PNG 字节串"""
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    rows, cols = image.shape[:2]
+    raw   = np.zeros((rows, 1 + 3*cols), dtype=np.uint8)   # 每行前加过滤类型 0
+    raw[:, 1:] = image.reshape(rows, -1)
+    return b'\x89PNG\r\n\x1a\n' \
+        + png_chunk(b'IHDR', struct.pack('>IIBBBBB', cols, rows, 8, 2, 0, 0, 0)) \
+        + png_chunk(b'IDAT', zlib.compress(raw.tobytes(), level)) \
+        + png_chunk(b'IEND', b'')
+
+
+def write_indexed_png(file, index, palette, overlays=(), level=6, band=256):
+    """
+    将地块编号矩阵 index 按调色板 palette 写为索引色 PNG，每个格点对应一个像素
+
+    overlays 为 (行, 列, 编号) 的列表，写入前将这些像素的编号替换为给定编号。
+    按 band 行分块读取 index 并逐块压缩，index 可以是内存映射数组；调色板不超过 16 色时每像素占 4 位。
+    """
+    palette = np.asarray(palette, dtype=np.uint8)
+    rows, cols = index.shape
+    depth   = 4 if len(palette) <= 16 else 8
+    overlays = [(np.asarray(r), np.asarray(c), value) for r, c, value in overlays]
+    compressor = zlib.compressobj(level)
+    with open(file, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', cols, rows, depth, 3, 0, 0, 0)))
+        f.write(png_chunk(b'PLTE', palette.tobytes()))
+        for i0 in range(0, rows, band):
+            i1    = min(i0 + band, rows)
+            block = np.array(index[i0:i1], dtype=np.uint8)
+            for r, c, value in overlays:
+                inside = (r >= i0) & (r < i1)
+                block[r[inside] - i0, c[inside]] = value
+            if depth == 4:
+                if cols % 2: block = np.pad(block, ((0, 0), (0, 1)))
+                block = (block[:, 0::2] << 4) | block[:, 1::2]
+            raw = np.zeros((i1 - i0, 1 + block.shape[1]), dtype=np.uint8)   # 每行前加过滤类型 0
+            raw[:, 1:] = block
+            data = compressor.compress(raw.tobytes())
+            if data: f.write(png_chunk(b'IDAT', data))
+        f.write(png_chunk(b'IDAT', compressor.flush()))
+        f.write(png_chunk(b'IEND', b''))
+    return file
+
+
+class ImageCache:
+    """RGB 图像缓存，地图变化时只重绘变化的区域"""
+    def __init__(self, palette):
+        self.palette = palette
+        self.invalidate()
+
+    def __call__(self, map):
+        if self.map is None or self.map.shape != map.shape:
+            self.image = render(map, self.palette)
+            self.map   = map.copy()
+        else:
+            diff = self.map != map
+            rows = np.flatnonzero(diff.any(axis=1))
+            if rows.size > 0:
+                cols   = np.flatnonzero(diff.any(axis=0))
+                region = (slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1))
+                self.image[region] = render(map[region], self.palette)
+                self.map[region]   = map[region]
+        return self.image
+
+    def invalidate(self):
+        """清空缓存，下次调用时全部重绘"""
+        self.map   = None
+        self.image = None
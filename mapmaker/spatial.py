@@ -0,0 +1,118 @@
+"""
+城市和河流的空间索引
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class PointIndex:
+    """
+    二维点表的 KD 树查询，返回点的下标，城市表和 SpatialIndex 共用
+
+    points 形状为 (点数, 2)，KD 树在首次查询时建立。
+    """
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.tree   = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def build(self):
+        """按需建立 KD 树"""
+        if self.tree is None: self.tree = cKDTree(self.points)
+        return self.tree
+
+    def within(self, x, y, radius):
+        """与点 (x, y) 距离不超过 radius 的点下标，按距离从近到远排列"""
+        index = np.asarray(self.build().query_ball_point((x, y), radius), dtype=np.int64)
+        dist  = np.hypot(self.points[index, 0] - x, self.points[index, 1] - y)
+        return index[np.argsort(dist, kind='stable')]
+
+    def nearest(self, x, y, k=1):
+        """距离点 (x, y) 最近的 k 个点下标，按距离从近到远排列"""
+        k = min(k, len(self))
+        if k == 0: return np.zeros(0, dtype=np.int64)
+        return np.atleast_1d(self.build().query((x, y), k)[1])
+
+    def in_box(self, left, right, bottom, top):
+        """位于矩形 [left, right] x [bottom, top] 中的点下标"""
+        x, y = self.points.T
+        return np.flatnonzero((x >= left) & (x <= right) & (y >= bottom) & (y <= top))
+
+    def near(self, points, radius):
+        """与 points（形状为 (2, 点数)）中任一点距离不超过 radius 的点下标"""
+        points = np.asarray(points, dtype=float).reshape(2, -1).T
+        if len(points) == 0 or len(self) == 0: return np.zeros(0, dtype=np.int64)
+        dist, _ = cKDTree(points).query(self.points, distance_upper_bound=radius)
+        return np.flatnonzero(dist <= radius)
+
+
+class SpatialIndex:
+    """
+    按对象保存二维点的空间索引，每个对象可有一个或多个点（如城市的位置、河流的各点）
+
+    增删对象只修改点表，查询前按需重建 KD 树，重建用时为 O(n log n)。
+    坐标形状与河流的 points 相同，为 (2, 点数)，即 [[x, ...], [y, ...]]。
+    """
+    def __init__(self):
+        self.groups = {}
+        self.tree   = None
+        self.dirty  = False
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __contains__(self, item):
+        return item in self.groups
+
+    def add(self, item, points):
+        """加入对象或替换对象的点"""
+        self.groups[item] = np.asarray(points, dtype=float).reshape(2, -1).T
+        self.dirty = True
+
+    def remove(self, *items):
+        for item in items: self.groups.pop(item, None)
+        self.dirty = True
+
+    def clear(self):
+        self.groups.clear()
+        self.dirty = True
+
+    def build(self):
+        """按需重建 KD 树"""
+        if not self.dirty and self.tree is not None: return self
+        self.items  = list(self.groups)
+        sizes       = [len(points) for points in self.groups.values()]
+        self.tree   = PointIndex(np.concatenate([np.zeros((0, 2)), *self.groups.values()]))
+        self.owner  = np.repeat(np.arange(len(self.items)), sizes)
+        self.dirty  = False
+        return self
+
+    def within(self, x, y, radius):
+        """与点 (x, y) 距离不超过 radius 的对象，按距离从近到远排列"""
+        return self.__unique(self.build().tree.within(x, y, radius))
+
+    def nearest(self, x, y, k=1):
+        """距离点 (x, y) 最近的 k 个对象，按距离从近到远排列"""
+        tree = self.build().tree
+        n = k
+        while True:
+            found = self.__unique(tree.nearest(x, y, n))
+            if len(found) >= k or n >= len(tree): return found[:k]
+            n *= 2
+
+    def in_box(self, left, right, bottom, top):
+        """有点位于矩形 [left, right] x [bottom, top] 中的对象"""
+        return self.__unique(self.build().tree.in_box(left, right, bottom, top))
+
+    def near(self, points, radius):
+        """有点与 points（形状为 (2, 点数)）中任一点距离不超过 radius 的对象"""
+        return self.__unique(self.build().tree.near(points, radius))
+
+    def __unique(self, index):
+        # 按 index 中首次出现的顺序返回对应的对象
+        owner = self.owner[index]
+        _, first = np.unique(owner, return_index=True)
+        return [self.items[i] for i in owner[np.sort(first)]]
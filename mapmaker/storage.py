@@ -0,0 +1,104 @@
+"""
+地图数据的二进制存储
+
+每张地图的数据储存在 data/<地图名> 文件夹中：
+    map.npy        地块编号矩阵，可用 np.load(mmap_mode='r') 内存映射读取
+    altitude.npy   高度图
+    <河流名>.npy   河流各点坐标，形状为 (2, 点数)
+    <河流名>.json  河流的关键点、随机种子和各段点数，用于重新生成部分线段
+    city.npy       城市名、坐标和人口的结构化数组（旧版为 city.txt）
+    meta.json      生成参数
+旧版本的 map.txt, altitude.txt 和河流 .txt 文件可通过 migrate 转换。
+"""
+
+import json
+import os
+import threading
+import zlib
+import numpy as np
+import pandas as pd
+
+from .data.color_dict import color_dict
+
+
+text_files = ('city.txt', 'river_name.txt')
+land_dtype = np.min_scalar_type(len(color_dict) - 1)
+
+
+def read_text(file):
+    """读取逗号分隔的旧版文本矩阵，空文件返回空数组"""
+    if os.path.getsize(file) == 0:
+        return np.array([])
+    return pd.read_csv(file, sep=',', header=None).values
+
+
+def save_array(file, array):
+    """
+    以 .npy 格式保存数组
+
+    先写入同一文件夹中的临时文件再替换原文件，正在内存映射原文件的数组仍读取旧文件，不会读到写了一半的数据。
+    """
+    temp = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp, 'wb') as f:
+            np.save(f, np.asarray(array))
+        os.replace(temp, file)
+    except BaseException:
+        if os.path.exists(temp): os.remove(temp)
+        raise
+
+
+def load_array(file, mmap_mode='r'):
+    """读取 .npy 数组（默认内存映射），.txt 文件按旧版文本格式读取"""
+    if file.endswith('.txt'):
+        return read_text(file)
+    return np.load(file, mmap_mode=mmap_mode)
+
+
+def save_meta(file, **meta):
+    """以 json 格式保存生成参数"""
+    with open(file, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+
+
+def load_meta(file):
+    """读取生成参数，文件不存在时返回空字典"""
+    if not os.path.exists(file):
+        return {}
+    with open(file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class CompressedArray:
+    """zlib 压缩保存的数组，np.asarray 时解压"""
+    def __init__(self, array, level=1):
+        array      = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.data  = zlib.compress(array.tobytes(), level)
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.frombuffer(zlib.decompress(self.data), dtype=self.dtype).reshape(self.shape)
+        return array if dtype is None else array.astype(dtype)
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+
+def migrate(path, remove=False):
+    """将文件夹中的旧版文本矩阵转换为 .npy 文件，已有较新 .npy 文件的跳过，返回转换的文件列表"""
+    migrated = []
+    for file_name in sorted(os.listdir(path)):
+        if not file_name.endswith('.txt') or file_name in text_files:
+            continue
+        text_file  = os.path.join(path, file_name)
+        array_file = text_file[:-len('.txt')] + '.npy'
+        if not os.path.exists(array_file) or os.path.getmtime(array_file) < os.path.getmtime(text_file):
+            array = read_text(text_file)
+            # 地块编号矩阵按与 MapBase.land_dtype 相同的最小整数类型保存，可直接内存映射使用
+            if np.issubdtype(array.dtype, np.integer): array = array.astype(land_dtype)
+            save_array(array_file, array)
+            migrated.append(array_file)
+        if remove: os.remove(text_file)
+    return migrated
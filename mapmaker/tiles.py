@@ -0,0 +1,230 @@
+"""
+地图瓦片渲染和本地瓦片服务
+
+按 XYZ 方式将已保存的地图切分为 tile_size x tile_size 的 RGB 瓦片：第 z 级共 2^z x 2^z 块，
+最高级 max_zoom 时一个像素对应一个格点，更高级别按最近邻放大，较低级别使用保存的地图金字塔
+（见 pyramid 模块），没有金字塔时按间隔取样。地图数据以内存映射方式读取，每块瓦片只读取所需的格点。
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from . import pyramid, storage
+from .data.color_dict import color_dict
+from .render import (city_color, draw_markers, draw_polyline, encode_png, make_palette, render, 
+    river_color, to_cell)
+from .unit import Cities
+
+
+class LRUCache:
+    """按占用字节数淘汰最久未使用项的缓存，可在多线程中使用"""
+    def __init__(self, max_bytes=64*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.items     = OrderedDict()
+        self.lock      = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """取出缓存项，不存在时返回 None"""
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        """放入缓存项，超出 max_bytes 时淘汰最久未使用的项，单项超出 max_bytes 时不缓存"""
+        size = value.nbytes if hasattr(value, 'nbytes') else len(value)
+        with self.lock:
+            if key in self.items: self.nbytes -= self.__size(self.items.pop(key))
+            if size > self.max_bytes: return value
+            self.items[key] = value
+            self.nbytes    += size
+            while self.nbytes > self.max_bytes:
+                _, old = self.items.popitem(last=False)
+                self.nbytes -= self.__size(old)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def __size(self, value):
+        return value.nbytes if hasattr(value, 'nbytes') else len(value)
+
+
+class TileSource:
+    """
+    从 data/<地图名> 文件夹读取地图并渲染瓦片，瓦片和 PNG 编码结果缓存在 cache 中
+
+    range=[left, right, bottom, top] 为城市和河流坐标对应的地图范围，默认读取 meta.json 中保存的范围。
+    """
+    extra_zoom = 8
+
+    def __init__(self, path, tile_size=256, range=None, rivers=True, cities=True,
+        cache_bytes=64*2**20, colors=color_dict):
+        self.path      = path
+        self.tile_size = tile_size
+        if not os.path.exists(os.path.join(path, 'map.npy')): storage.migrate(path)
+        self.map       = storage.load_array(os.path.join(path, 'map.npy'))
+        self.meta      = storage.load_meta(os.path.join(path, 'meta.json'))
+        self.rows, self.cols = self.map.shape
+        self.range     = range or self.meta.get('range', [0, self.cols, 0, self.rows])
+        self.max_zoom  = max(int(np.ceil(np.log2(max(self.rows, self.cols)/tile_size))), 0)
+        self.levels    = self.read_levels()
+        self.palette   = make_palette(colors)
+        self.cache     = LRUCache(cache_bytes)
+        self.rivers    = self.read_rivers() if rivers else []
+        self.cities    = self.read_cities() if cities else np.zeros((2, 0))
+
+    def read_levels(self):
+        """内存映射读取不比 map.npy 旧的金字塔各层，{层号: 地图}"""
+        levels = {}
+        for k, file in pyramid.levels(self.path).items():
+            if os.path.getmtime(file) < os.path.getmtime(os.path.join(self.path, 'map.npy')): break
+            levels[k] = storage.load_array(file)
+        return levels
+
+    def read_rivers(self):
+        """读取各条河流的格点坐标 (行, 列)"""
+        file = os.path.join(self.path, 'river_name.txt')
+        if not os.path.exists(file): return []
+        rivers = []
+        for name in storage.read_text(file).reshape(-1).tolist():
+            file = os.path.join(self.path, f'{name}.npy')
+            if os.path.exists(file): rivers.append(self.to_cell(*np.load(file)))
+        return rivers
+
+    def read_cities(self):
+        """读取城市的格点坐标，形状为 (2, 城市数)"""
+        cities = Cities.load(os.path.join(self.path, 'city.npy'))
+        return np.array(self.to_cell(cities.x, cities.y))
+
+    def to_cell(self, x, y):
+        """将绘图坐标 (x, y) 转换为格点坐标 (行, 列)"""
+        return to_cell(x, y, self.range, (self.rows, self.cols))
+
+    def tiles(self, z):
+        """第 z 级在行、列方向上含有地图的瓦片数"""
+        size = self.tile_size << self.max_zoom
+        return -(-(self.rows << z) // size), -(-(self.cols << z) // size)
+
+    def contains(self, z, x, y):
+        """瓦片是否存在，最多比 max_zoom 放大 extra_zoom 级"""
+        if not 0 <= z <= self.max_zoom + self.extra_zoom: return False
+        rows, cols = self.tiles(z)
+        return 0 <= y < rows and 0 <= x < cols
+
+    def tile(self, z, x, y):
+        """第 z 级第 y 行第 x 列的 RGB 瓦片，地图以外的部分为背景色"""
+        key   = ('rgb', z, x, y)
+        image = self.cache.get(key)
+        if image is not None: return image
+        n     = np.arange(self.tile_size)
+        rows  = ((y*self.tile_size + n) << self.max_zoom) >> z
+        cols  = ((x*self.tile_size + n) << self.max_zoom) >> z
+        rows, cols = rows[rows < self.rows], cols[cols < self.cols]
+        image = np.empty((self.tile_size, self.tile_size, 3), dtype=np.uint8)
+        image[:] = self.palette[0]
+        if rows.size and cols.size:
+            # 放大时 rows, cols 有重复，先读取所需的矩形区域再按下标取值
+            if z > self.max_zoom:
+                block = np.asarray(self.map[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1])
+                cells = block[np.ix_(rows - rows[0], cols - cols[0])]
+            elif self.max_zoom - z in self.levels:
+                k     = self.max_zoom - z
+                cells = self.levels[k][rows[0] >> k:(rows[-1] >> k) + 1, cols[0] >> k:(cols[-1] >> k) + 1]
+            else:
+                step  = 1 << (self.max_zoom - z)
+                cells = self.map[rows[0]:rows[-1]+1:step, cols[0]:cols[-1]+1:step]
+            render(cells, self.palette, out=image[:rows.size, :cols.size])
+        self.draw_overlay(image, z, x, y)
+        return self.cache.put(key, image)
+
+    def draw_overlay(self, image, z, x, y):
+        """在瓦片上画出河流和城市"""
+        scale = 2.0**(z - self.max_zoom)
+        r0, c0 = y*self.tile_size, x*self.tile_size
+        width = max(1, int(scale))
+        for rows, cols in self.rivers:
+            draw_polyline(image, rows*scale - r0, cols*scale - c0, river_color, width)
+        if self.cities.shape[1] > 0:
+            draw_markers(image, self.cities[0]*scale - r0, self.cities[1]*scale - c0, city_color)
+        return image
+
+    def png(self, z, x, y):
+        """PNG 编码的瓦片"""
+        key  = ('png', z, x, y)
+        data = self.cache.get(key)
+        if data is None: data = self.cache.put(key, encode_png(self.tile(z, x, y)))
+        return data
+
+    def info(self):
+        """供客户端使用的地图信息"""
+        return {
+            'name'     : self.meta.get('name', os.path.basename(self.path)),
+            'rows'     : self.rows,
+            'cols'     : self.cols,
+            'tile_size': self.tile_size,
+            'max_zoom' : self.max_zoom,
+        }
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    """响应 /<z>/<x>/<y>.png 和 /info.json 请求"""
+    source = None
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['info.json']:
+            return self.send(200, 'application/json', json.dumps(self.source.info(), ensure_ascii=False).encode())
+        try:
+            z, x, y = int(parts[0]), int(parts[1]), int(parts[2].removesuffix('.png'))
+        except (IndexError, ValueError):
+            return self.send(404, 'text/plain', b'Not found')
+        if len(parts) != 3 or not self.source.contains(z, x, y):
+            return self.send(404, 'text/plain', b'Not found')
+        self.send(200, 'image/png', self.source.png(z, x, y))
+
+    def send(self, code, kind, body):
+        self.send_response(code)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(source, host='127.0.0.1', port=8000):
+    """创建瓦片服务，source 为 TileSource 或地图文件夹路径"""
+    if not isinstance(source, TileSource): source = TileSource(source)
+    handler = type('Handler', (TileHandler,), {'source': source})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(source, host='127.0.0.1', port=8000):
+    """启动瓦片服务，直到按 Ctrl+C 停止"""
+    server = make_server(source, host, port)
+    print(f'Serving tiles on http://{host}:{server.server_port}/<z>/<x>/<y>.png')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
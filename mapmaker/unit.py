@@ -1,7 +1,11 @@
+import os
+
 import numpy as np
-from numpy import random
+import pandas as pd
 
+from . import storage
 from .randombase import RandomBase
+from .spatial import PointIndex
 
 
 class City:
@@ -14,17 +18,132 @@ class City:
         return f'{self.name} locates on {self.location}.'
 
 
+class Cities:
+    """
+    按列储存的城市表，names, x, y, population 为等长数组
+
+    增删城市按批进行，遍历或按下标取出时生成 City 对象（修改 City 对象不影响城市表）。
+    按坐标查询时使用 KD 树，增删后首次查询时重建。
+    """
+    columns = ('name', 'x', 'y', 'population')
+
+    def __init__(self, names=(), x=(), y=(), population=None):
+        self.names      = np.array(names, dtype=object).reshape(-1)
+        self.x          = np.array(x, dtype=float).reshape(-1)
+        self.y          = np.array(y, dtype=float).reshape(-1)
+        if population is None: population = np.zeros(len(self.names))
+        self.population = np.array(population, dtype=np.int64).reshape(-1)
+        if not len(self.names) == len(self.x) == len(self.y) == len(self.population): 
+            raise ValueError('names, x, y and population must have the same length')
+        self.tree       = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def __getitem__(self, i):
+        return City([self.x[i], self.y[i]], self.names[i], int(self.population[i]))
+
+    def __repr__(self):
+        return f'{len(self)} cities.'
+
+    @property
+    def location(self):
+        """各城市坐标，形状为 (2, 城市数)"""
+        return np.stack([self.x, self.y])
+
+    def take(self, index):
+        """按下标取出 City 对象列表"""
+        return [self[i] for i in index]
+
+    def add(self, names, x, y, population=None):
+        """在表尾批量加入城市"""
+        new = Cities(names, x, y, population)
+        self.names      = np.concatenate([self.names, new.names])
+        self.x          = np.concatenate([self.x, new.x])
+        self.y          = np.concatenate([self.y, new.y])
+        self.population = np.concatenate([self.population, new.population])
+        self.tree       = None
+        return self
+
+    def remove(self, names):
+        """批量删除给定名称的城市，返回删除的城市数"""
+        keep = ~pd.Series(self.names).isin(list(names)).values
+        self.names, self.x, self.y, self.population = (self.names[keep], self.x[keep], self.y[keep], 
+            self.population[keep])
+        self.tree = None
+        return int(len(keep) - keep.sum())
+
+    def rename(self, old_name, new_name):
+        self.names[self.names == old_name] = new_name
+
+    def to_records(self):
+        """转换为结构化数组，字段为 name, x, y, population"""
+        width   = max([len(name) for name in self.names.tolist()], default=1)
+        records = np.empty(len(self), dtype=[('name', f'U{max(width, 1)}'), ('x', float), ('y', float), 
+            ('population', np.int64)])
+        records['name'], records['x'], records['y'] = self.names, self.x, self.y
+        records['population'] = self.population
+        return records
+
+    def save(self, file):
+        """以 .npy 结构化数组一次写入所有城市"""
+        storage.save_array(file, self.to_records())
+
+    @classmethod
+    def load(cls, file):
+        """读取 .npy 城市文件，文件不存在时读取同名的旧版 .txt 文件（名称, x, y）"""
+        if not os.path.exists(file) and file.endswith('.npy'): file = file[:-len('.npy')] + '.txt'
+        if not os.path.exists(file) or os.path.getsize(file) == 0: return cls()
+        if file.endswith('.txt'): 
+            table = pd.read_csv(file, header=None, names=cls.columns, skipinitialspace=True, 
+                dtype={'name': str, 'x': float, 'y': float, 'population': float})
+            return cls(table['name'].values, table['x'].values, table['y'].values, 
+                table['population'].fillna(0).values)
+        records = np.load(file)
+        return cls(records['name'].astype(object), records['x'], records['y'], records['population'])
+
+    def build(self):
+        """按需重建 KD 树"""
+        if self.tree is None: self.tree = PointIndex(np.column_stack([self.x, self.y]))
+        return self.tree
+
+    def within(self, x, y, radius):
+        """与点 (x, y) 距离不超过 radius 的城市下标，按距离从近到远排列"""
+        return self.build().within(x, y, radius)
+
+    def nearest(self, x, y, k=1):
+        """距离点 (x, y) 最近的 k 个城市下标"""
+        return self.build().nearest(x, y, k)
+
+    def in_box(self, left, right, bottom, top):
+        """位于矩形 [left, right] x [bottom, top] 中的城市下标"""
+        return self.build().in_box(left, right, bottom, top)
+
+    def near(self, points, radius):
+        """与 points（形状为 (2, 点数)）中任一点距离不超过 radius 的城市下标"""
+        return self.build().near(points, radius)
+
+
 class River(RandomBase):
+    """
+    河流对象，由关键点之间的线段经多次中点位移生成
+
+    各点坐标储存在形状为 (2, 点数) 的数组 points 中，segments 为各段线段在 points 中的视图，
+    重新生成点数不变的线段时直接写入 points。
+    """
     def __init__(self, keypoints=None, insert_times=None, 
         delta_length=1, intensity=0.5, 
-        name='unnamed river', seed=None): 
-        super().__init__(seed)
+        name='unnamed river', seed=None, legacy=None): 
+        super().__init__(seed, legacy=legacy)
         self.var_seed = self.seed
         self.name         = name
         self.delta_length = delta_length
         self.intensity    = intensity
         self.keypoints    = [[], []]
-        self.points       = [[], []]
+        self.points       = np.zeros((2, 0))
         self.segments     = []
         if type(keypoints) == np.ndarray: 
             self.keypoints = keypoints.tolist()
@@ -34,13 +153,14 @@ class River(RandomBase):
         return f'{self.name} has {len(self.keypoints[0])} keypoints.'
 
     def full_random(self, insert_times=None): 
+        """按关键点重新生成所有线段"""
+        self.__join([])
         if len(self.keypoints[0]) > 1:
-            X0 = self.keypoints[0][:-1]
-            Y0 = self.keypoints[1][:-1]
-            X1 = self.keypoints[0][1:]
-            Y1 = self.keypoints[1][1:]
-            for xyxy in np.array([X0, Y0, X1, Y1]).T.tolist():
-                self.__generate_segment(*xyxy, insert_times)
+            randomize_rivers([(self, *self.segment_ends(), None)], insert_times)
+    
+    def change_segments(self, indices=None, insert_times=None): 
+        """重新随机生成编号为 indices 的线段（默认全部），其余线段不变"""
+        change_rivers([self], indices, insert_times)
     
     def full_refine(self, delta_length=None):
         if delta_length: 
@@ -53,45 +173,167 @@ class River(RandomBase):
         self.keypoints[0].append(x)
         self.keypoints[1].append(y)
         if len(self.keypoints[0]) > 1 and refine:
-            x0 = self.keypoints[0][-2]
-            y0 = self.keypoints[1][-2]
-            self.__generate_segment(x0, y0, x, y, insert_times)
-
-    def __generate_segment(self, x0, y0, x1, y1, insert_times=None): 
-        r = np.sqrt((x0 - x1)**2 + (y0 - y1)**2)
-        if not insert_times: 
-            insert_times = int(np.log2(r/self.delta_length)) + 1
-            if insert_times < 0: insert_times = 0
-        segment = self.__change_segment(x0, y0, x1, y1, insert_times)
-        self.segments.append(segment)
-        self.points[0] += segment[0]
-        self.points[1] += segment[1]
-    
-    def __change_segment(self, x0, y0, x1, y1, insert_times): 
-        X = [x0, x1]
-        Y = [y0, y1]
-        for _ in range(insert_times):
-            X, Y = self.__change_line(X, Y, self.intensity)
-        return [X, Y]
+            randomize_rivers([(self, *self.segment_ends([len(self.keypoints[0]) - 2]), None)], insert_times)
+
+    def segment_ends(self, indices=None): 
+        """编号为 indices 的线段（默认全部）的起点和终点，形状均为 (2, 段数)"""
+        keypoints = np.array(self.keypoints, dtype=float).reshape(2, -1)
+        if indices is None: indices = range(keypoints.shape[1] - 1)
+        indices = np.asarray(list(indices), dtype=np.int64)
+        return keypoints[:, indices], keypoints[:, indices + 1]
+
+    def plan_segments(self, start, end, insert_times=None): 
+        """
+        为起点 start 到终点 end（形状均为 (2, 段数)）的各段线段安排中点位移次数和每次位移的随机种子
+
+        返回 (各段位移次数, 各段每次位移的种子列表)，并按生成顺序推进 var_seed。
+        """
+        if insert_times: 
+            times = np.full(start.shape[1], insert_times, dtype=np.int64)
+        else: 
+            r = np.sqrt((start[0] - end[0])**2 + (start[1] - end[1])**2)
+            with np.errstate(divide='ignore'): 
+                times = np.log2(r/self.delta_length)
+            times = np.where(np.isfinite(times), times, -1).astype(np.int64) + 1
+            times[times < 0] = 0
+        seeds = []
+        for t in times.tolist(): 
+            # 第 l 次位移前有 2^l + 1 个点，每次位移后种子增加 2 倍点数
+            n = 2**np.arange(t) + 1
+            seeds.append((self.var_seed + np.concatenate([[0], np.cumsum(2*n)[:-1]])).tolist())
+            self.var_seed += int(2*n.sum())
+        return times, seeds
+
+    def segment_random(self, seed, n): 
+        """种子为 seed 的一次中点位移所用的 (2, n) 随机数，取值范围为 [-0.5, 0.5)"""
+        rng = self.spawn_rng('river', seed, legacy_seed=seed)
+        return rng.random((2, n)) - 0.5
+
+    def set_segments(self, segments, index=None): 
+        """
+        用新生成的线段替换编号为 index 的线段，index 为 None 时加在最后
+
+        替换的线段点数都不变时直接写入 points，否则重新拼接 points。
+        """
+        if index is None: 
+            return self.__join(self.segments + list(segments))
+        if all(self.segments[i].shape == s.shape for i, s in zip(index, segments)): 
+            for i, s in zip(index, segments): self.segments[i][...] = s
+            return
+        parts = list(self.segments)
+        for i, s in zip(index, segments): parts[i] = s
+        self.__join(parts)
+
+    def __join(self, segments): 
+        self.points   = np.concatenate([np.zeros((2, 0)), *segments], axis=1)
+        bounds        = np.cumsum([0] + [s.shape[1] for s in segments])
+        self.segments = [self.points[:, a:b] for a, b in zip(bounds[:-1], bounds[1:])]
     
-    def __change_line(self, X, Y, intensity): 
-        n = len(X)
-        new_X = []
-        new_Y = []
-        random.seed(self.var_seed)
-        self.var_seed += 2*n
-        randmat = random.rand(2,n) - 0.5
-        for i in range(n-1):
-            new_X.append(X[i])
-            new_Y.append(Y[i])
-            length = np.sqrt((X[i] - X[i+1])**2 + (Y[i] - Y[i+1])**2)
-            new_X.append(0.5*X[i] + 0.5*X[i+1] + intensity*length*randmat[0,i])
-            new_Y.append(0.5*Y[i] + 0.5*Y[i+1] + intensity*length*randmat[1,i])
-        new_X.append(X[-1])
-        new_Y.append(Y[-1])
-        return new_X, new_Y
+    def meta(self): 
+        """重新生成河流所需的参数"""
+        return {
+            'keypoints'   : np.array(self.keypoints, dtype=float).reshape(2, -1).tolist(), 
+            'seed'        : self.seed, 
+            'var_seed'    : self.var_seed, 
+            'delta_length': self.delta_length, 
+            'intensity'   : self.intensity, 
+            'segments'    : [s.shape[1] for s in self.segments], 
+        }
     
     def save(self, path='data', file_name=None): 
+        """将各点坐标保存为 <河流名>.npy，生成参数保存为同名 .json 文件"""
         if len(self.points[0]) > 2: 
-            if not file_name: file_name = path + '/' + self.name + '.txt'
-            np.savetxt(file_name, self.points, delimiter=', ')
+            if not file_name: file_name = path + '/' + self.name + '.npy'
+            storage.save_array(file_name, self.points)
+            storage.save_meta(os.path.splitext(file_name)[0] + '.json', **self.meta())
+    
+    def load(self, file): 
+        """读取 save 保存的河流，没有 .json 文件的旧数据只读取各点坐标，不能重新生成"""
+        self.points   = np.array(storage.load_array(file), dtype=float)
+        self.segments = [self.points]
+        meta = storage.load_meta(os.path.splitext(file)[0] + '.json')
+        if meta: 
+            self.set_random_seed(meta['seed'])
+            self.keypoints    = meta['keypoints']
+            self.var_seed     = meta['var_seed']
+            self.delta_length = meta['delta_length']
+            self.intensity    = meta['intensity']
+            if sum(meta['segments']) == self.points.shape[1]: 
+                bounds        = np.cumsum([0] + meta['segments'])
+                self.segments = [self.points[:, a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        return self
+
+
+def midpoint_displacement(start, end, times, intensity, randmat): 
+    """
+    批量中点位移，start 和 end 为各段起点和终点，形状为 (2, 段数)，times 和 intensity 为各段的位移次数和强度
+
+    第 l 次位移时所有未完成的线段都有 2^l + 1 个点，合并为一个 (2, 段数, 点数) 数组整体计算，
+    randmat(s, l) 返回第 s 段第 l 次位移所用的 (2, 点数) 随机数。返回各段的 (2, 点数) 坐标数组列表。
+    """
+    times     = np.asarray(times)
+    intensity = np.broadcast_to(np.asarray(intensity, dtype=float), times.shape)
+    result    = [None]*len(times)
+    active    = np.arange(len(times))
+    points    = np.stack([start, end], axis=2).astype(float)
+    for l in range(int(times.max(initial=0)) + 1): 
+        done = times[active] == l
+        for s, p in zip(active[done].tolist(), points[:, done].swapaxes(0, 1)): 
+            result[s] = np.ascontiguousarray(p)
+        active, points = active[~done], points[:, ~done]
+        if active.size == 0: break
+        n      = points.shape[2]
+        X, Y   = points
+        # float_power 与逐点计算时的标量乘方舍入一致，数组的 **2 按 x*x 计算，个别结果会差一位
+        length = np.sqrt(np.float_power(X[:, :-1] - X[:, 1:], 2) + np.float_power(Y[:, :-1] - Y[:, 1:], 2))
+        rand   = np.stack([randmat(s, l) for s in active.tolist()], axis=1)
+        new    = np.empty((2, len(active), 2*n - 1))
+        new[:, :, 0::2] = points
+        new[:, :, 1::2] = 0.5*points[:, :, :-1] + 0.5*points[:, :, 1:] \
+            + intensity[active, None]*length*rand[:, :, :n-1]
+        points = new
+    return result
+
+
+def randomize_rivers(jobs, insert_times=None): 
+    """
+    将多条河流的新线段合并为一次批量中点位移生成
+
+    jobs 为 (河流, 起点, 终点, 编号) 的列表，起点和终点形状为 (2, 段数)，
+    生成的线段替换各条河流中对应编号的线段，编号为 None 时加在最后，见 River.set_segments。
+    """
+    owners, starts, ends, times, seeds, intensity = [], [], [], [], [], []
+    for river, start, end, index in jobs: 
+        t, s = river.plan_segments(start, end, insert_times)
+        owners    += [river]*len(t)
+        seeds     += s
+        starts.append(start)
+        ends.append(end)
+        times.append(t)
+        intensity.append(np.full(len(t), river.intensity, dtype=float))
+    if not owners: return
+    randmat  = lambda s, l: owners[s].segment_random(seeds[s][l], 2**l + 1)
+    segments = midpoint_displacement(np.concatenate(starts, axis=1), np.concatenate(ends, axis=1), 
+        np.concatenate(times), np.concatenate(intensity), randmat)
+    k = 0
+    for river, start, end, index in jobs: 
+        river.set_segments(segments[k:k + start.shape[1]], index)
+        k += start.shape[1]
+
+
+def change_rivers(rivers, indices=None, insert_times=None): 
+    """
+    批量重新随机生成多条河流中编号为 indices 的线段（默认全部），其余线段不变
+
+    线段与关键点不对应（如 add_point 时 refine=False）的河流重新生成所有线段，没有关键点的河流不变。
+    """
+    jobs = []
+    for river in rivers: 
+        count = len(river.keypoints[0]) - 1
+        if count < 1: continue
+        if len(river.segments) != count: 
+            river.full_random(insert_times)
+            continue
+        index = range(count) if indices is None else [i for i in indices if 0 <= i < count]
+        jobs.append((river, *river.segment_ends(index), index))
+    randomize_rivers(jobs, insert_times)
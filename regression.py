@@ -0,0 +1,114 @@
+import heapq
+import tempfile
+
+import numpy as np
+
+from mapmaker import AltitudeMap, Map
+from mapmaker import hydrology, kernels
+from mapmaker.noise import Perlin2d
+
+
+def weathering_reference(map, randmat, intensity):
+    """逐格计算的风化，与旧版本的循环相同"""
+    rows, cols = map.shape
+    out = map.copy()
+    for i in range(1, rows-1):
+        for j in range(1, cols-1):
+            if randmat[i,j,0] > 1 - intensity:
+                out[i,j] = map[i+1, j]
+            elif randmat[i,j,0] < intensity:
+                out[i,j] = map[i-1, j]
+            if randmat[i,j,1] > 1 - intensity:
+                out[i,j] = map[i, j+1]
+            elif randmat[i,j,1] < intensity:
+                out[i,j] = map[i, j-1]
+    return out
+
+
+def priority_flood_reference(altitude, sea_level=0.0):
+    """用堆实现的优先级填洼，海洋和地图边缘为出口"""
+    rows, cols = altitude.shape
+    filled = np.full(altitude.shape, np.inf)
+    seen   = np.zeros(altitude.shape, dtype=bool)
+    heap   = []
+    for i in range(rows):
+        for j in range(cols):
+            if altitude[i,j] <= sea_level or i in (0, rows-1) or j in (0, cols-1):
+                seen[i,j]   = True
+                filled[i,j] = altitude[i,j]
+                heapq.heappush(heap, (altitude[i,j], i, j))
+    while heap:
+        level, i, j = heapq.heappop(heap)
+        for di, dj in hydrology.offsets:
+            a, b = i + di, j + dj
+            if 0 <= a < rows and 0 <= b < cols and not seen[a,b]:
+                seen[a,b]   = True
+                filled[a,b] = max(altitude[a,b], level)
+                heapq.heappush(heap, (filled[a,b], a, b))
+    return filled
+
+
+def check_weathering(seed=1586, shape=(60, 80), intensity=0.1):
+    """numpy 与 numba 风化和逐格循环逐位相同"""
+    rng     = np.random.default_rng(seed)
+    map     = rng.integers(0, 20, shape).astype(np.uint8)
+    randmat = rng.random((*shape, 2))
+    expect  = weathering_reference(map, randmat, intensity)
+    engines = ['numpy'] + (['numba'] if kernels.weathering_loop is not None else [])
+    for engine in engines:
+        assert np.array_equal(kernels.weathering(map, randmat, intensity, engine), expect), engine
+    return engines
+
+
+def check_perlin(seed=1586, cells=(10,10), shape=(80, 100)):
+    """柏林噪声整体计算与逐点计算逐位相同，legacy 模式与否均检查"""
+    X,Y = np.meshgrid(np.linspace(0, 100, shape[1], endpoint=False), np.linspace(0, 80, shape[0], endpoint=False))
+    for legacy in (True, False):
+        point = Perlin2d(cells, seed=seed, mode='point', legacy=legacy)(X, Y)
+        array = Perlin2d(cells, seed=seed, mode='array', legacy=legacy)(X, Y)
+        assert np.array_equal(point, array), legacy
+
+
+def check_tiled(seed=7777, resolution=3, tile_size=64):
+    """分块生成的高度图与整体生成相同"""
+    for smoothing in ('direct', 'separable'):
+        whole = AltitudeMap(seed=seed, resolution=resolution, smoothing=smoothing)
+        tiled = AltitudeMap(seed=seed, resolution=resolution, smoothing=smoothing, tile_size=tile_size)
+        assert np.array_equal(whole.map, tiled.map), smoothing
+
+
+def check_polish(path, seed=1586, times=3):
+    """合并计算的 polish 与逐轮计算相同，viewport 与整张地图 polish 后截取的区域相同"""
+    maps = [Map(seed=seed, name=name, data_path=path, cities=False, rivers=False)
+        for name in ('plain', 'fused', 'viewport')]
+    rows, cols = (100, 164), (200, 264)
+    region = maps[2].viewport(rows, cols, times=times)
+    maps[0].polish(times)
+    maps[1].polish(times, fused=True)
+    assert np.array_equal(maps[0].map, maps[1].map)
+    assert np.array_equal(maps[0].map[rows[0]:rows[1], cols[0]:cols[1]], region)
+
+
+def check_priority_flood(seed=1, trials=20):
+    """最小生成树实现的填洼与堆实现相同"""
+    rng = np.random.default_rng(seed)
+    for trial in range(trials):
+        altitude = rng.random(rng.integers(3, 40, 2))
+        altitude[altitude < 0.2] = 0
+        # 含大片等高区域
+        if trial % 3 == 0: altitude = np.round(altitude*4)/4
+        filled, _ = hydrology.priority_flood(altitude)
+        assert np.array_equal(filled, priority_flood_reference(altitude)), trial
+
+
+if __name__ == '__main__':
+    print('weathering:', ', '.join(check_weathering()))
+    check_perlin()
+    print('perlin: point == array')
+    check_tiled()
+    print('altitude: tiled == whole')
+    with tempfile.TemporaryDirectory() as path:
+        check_polish(path)
+    print('polish: fused == plain, viewport == crop')
+    check_priority_flood()
+    print('priority flood: == heap')